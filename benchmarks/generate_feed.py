@@ -0,0 +1,193 @@
+"""
+Generates synthetic Zillow feeds of any size for the benchmarks.
+
+The feed follows the schema of the syndication feed (see test_data/test_listings.xml), with the kind of variety the
+real feed has: bath fields that are missing or empty, long CDATA descriptions with markup and non ASCII characters
+in them, a varying number of Appliances, Rooms and Pictures, and MLS ids that repeat across boards. The same seed
+always produces the same bytes.
+
+    $ python generate_feed.py feed.xml 100000 --seed 0
+"""
+import argparse
+import random
+from xml.sax.saxutils import escape
+
+MLS_NAMES   = ['CLAW', 'CLAP', 'CRMLS', 'SDMLS', 'NTREIS', 'MRED', 'ARMLS', 'HAR']
+PLACES      = [('Malibu', 'CA', '90265'), ('Los Angeles', 'CA', '90049'), ('San Diego', 'CA', '92037'),
+               ('Dallas', 'TX', '75201'), ('Houston', 'TX', '77002'), ('Chicago', 'IL', '60611'),
+               ('Phoenix', 'AZ', '85004'), ('Scottsdale', 'AZ', '85251'), ('Austin', 'TX', '78701')]
+STREETS     = ['Castro Peak Mountainway', 'SADDLE PEAK RD', 'Ocean Ave', 'Main St', 'Elm St', 'Sunset Blvd',
+               'Lake Shore Dr', 'Camelback Rd', 'Congress Ave', 'Rue de la Paix']
+APPLIANCES  = ['Dishwasher', 'Dryer', 'Freezer', 'GarbageDisposal', 'Microwave', 'RangeOven', 'Refrigerator',
+               'TrashCompactor', 'Washer']
+ROOMS       = ['BreakfastNook', 'DiningRoom', 'FamilyRoom', 'LaundryRoom', 'Library', 'MasterBath', 'MudRoom',
+               'Office', 'Pantry', 'RecreationRoom', 'Workshop', 'SolariumAtrium', 'SunRoom', 'WalkInCloset']
+TYPES       = ['SingleFamily', 'Condo', 'Townhouse', 'VacantLand', 'MultiFamily']
+WORDS       = ('enjoy amazing ocean and island views from this acre parcel situated in a convenient peaceful area of '
+               'the mountains just minutes from beaches located off canyon sprinkled with vineyards ranches horse '
+               'properties paved road leads you to site which features considerable useable land multiple '
+               'development areas build your dream spectacular property perched on ridge between valley remodeled '
+               'kitchen granite counters hardwood floors open floor plan').split()
+# Descriptions sometimes carry markup and characters that need escaping or aren't ASCII. CDATA protects them.
+ODDITIES    = ['<b>Price reduced!</b>', 'A & B', 'café', 'résumé of upgrades', '3 < 4 > 2',
+               '★★★', 'line one\nline two', '"quoted"', "it's"]
+
+
+def _description(rng):
+    """
+    :returns: a description of anywhere from nothing to a few thousand characters
+    """
+    roll = rng.random()
+    if roll < 0.05:
+        return None
+    if roll < 0.1:
+        return ''
+    words = []
+    for i in range(rng.choice([5, 20, 40, 80, 200, 500])):
+        words.append(rng.choice(ODDITIES) if rng.random() < 0.02 else rng.choice(WORDS))
+    return ' '.join(words).capitalize() + '.'
+
+
+def _number(rng, value, missing=0.1, empty=0.1):
+    """
+    :returns: the value, '' for an empty element or None for a missing one
+    """
+    roll = rng.random()
+    if roll < missing:
+        return None
+    if roll < missing + empty:
+        return ''
+    return value
+
+
+def _element(name, value, indent):
+    if value is None:
+        return ''
+    if value == '':
+        return '%s<%s/>\n' % (indent, name)
+    return '%s<%s>%s</%s>\n' % (indent, name, escape(str(value)), name)
+
+
+def _list(name, item, values, indent):
+    if values is None:
+        return '%s<%s/>\n' % (indent, name)
+    inner = ''.join('%s  <%s>%s</%s>\n' % (indent, item, escape(value), item) for value in values)
+    return '%s<%s>\n%s%s</%s>\n' % (indent, name, inner, indent, name)
+
+
+def listing(rng, number, boards=None):
+    """
+    :param rng: a random.Random
+    :param number: the position of the listing in the feed
+    :param boards: optional dict of the boards that handed out each id so far, updated in place. Without it ids are
+                   never reused
+    :returns: the XML of a single listing
+    """
+    city, state, zip_code = rng.choice(PLACES)
+    mls_id = 14000000 + number
+    mls_name = rng.choice(MLS_NAMES)
+    # Every so often a board reuses an id another board already handed out, but a board never repeats its own id
+    if boards and rng.random() <= 0.02:
+        reused = 14000000 + rng.randrange(number)
+        others = [name for name in MLS_NAMES if name not in boards.get(reused, ())]
+        if reused in boards and others:
+            mls_id, mls_name = reused, rng.choice(others)
+    if boards is not None:
+        boards.setdefault(mls_id, []).append(mls_name)
+    street = '%d %s' % (rng.randrange(1, 30000), rng.choice(STREETS))
+    listed = '%d-%02d-%02d 00:00:00' % (rng.choice([2014, 2015, 2016, 2016, 2017]), rng.randrange(1, 13),
+                                         rng.randrange(1, 29))
+    price = _number(rng, '%.2f' % (rng.randrange(50, 5000) * 1000), missing=0.01, empty=0.02)
+
+    full = _number(rng, rng.randrange(0, 6), missing=0.2, empty=0.2)
+    half = _number(rng, rng.randrange(0, 3), missing=0.3, empty=0.3)
+    three_quarter = _number(rng, rng.randrange(0, 2), missing=0.4, empty=0.5)
+    bathrooms = _number(rng, rng.choice([1, 1.5, 2, 2.5, 3, 3.5, 4]), missing=0.3, empty=0.5)
+    bedrooms = _number(rng, rng.randrange(0, 7), missing=0.05, empty=0.05)
+
+    appliances = None if rng.random() < 0.4 else rng.sample(APPLIANCES, rng.randrange(1, len(APPLIANCES)))
+    rooms = None if rng.random() < 0.5 else rng.sample(ROOMS, rng.randrange(1, len(ROOMS)))
+    description = _description(rng)
+
+    parts = ['  <Listing>\n',
+             '    <Location>\n',
+             _element('StreetAddress', street, '      '),
+             '      <UnitNumber/>\n',
+             _element('City', city, '      '),
+             _element('State', state, '      '),
+             _element('Zip', zip_code, '      '),
+             _element('Lat', '%.6f' % rng.uniform(25, 48), '      '),
+             _element('Long', '%.6f' % rng.uniform(-124, -70), '      '),
+             '      <DisplayAddress>Yes</DisplayAddress>\n',
+             '    </Location>\n',
+             '    <ListingDetails>\n',
+             '      <Status>Active</Status>\n',
+             _element('Price', price, '      '),
+             _element('ListingUrl', 'http://www.example.com/property/%d/' % number, '      '),
+             _element('MlsId', mls_id, '      '),
+             _element('MlsName', mls_name, '      '),
+             _element('DateListed', listed, '      '),
+             '      <VirtualTourUrl><![CDATA[http://www.example.com/tour/%d/?a=1&b=2]]></VirtualTourUrl>\n' % number,
+             '    </ListingDetails>\n',
+             '    <BasicDetails>\n',
+             _element('PropertyType', rng.choice(TYPES), '      '),
+             _element('Title', street, '      ')]
+    if description is not None:
+        parts.append('      <Description><![CDATA[%s]]></Description>\n' % description)
+    parts += [_element('Bedrooms', bedrooms, '      '),
+              _element('Bathrooms', bathrooms, '      '),
+              _element('FullBathrooms', full, '      '),
+              _element('HalfBathrooms', half, '      '),
+              _element('ThreeQuarterBathrooms', three_quarter, '      '),
+              '      <LivingArea/>\n',
+              _element('LotSize', '%.2f' % rng.uniform(0.05, 20), '      '),
+              '    </BasicDetails>\n',
+              '    <Pictures>\n']
+    for i in range(rng.randrange(0, 26)):
+        parts.append('      <Picture>\n        <PictureUrl>http://media.example.com/pics/%d/%d/</PictureUrl>\n'
+                     '        <Caption/>\n      </Picture>\n' % (number, i))
+    parts += ['    </Pictures>\n',
+              '    <!-- agent details withheld -->\n',
+              '    <RichDetails>\n',
+              '      <AdditionalFeatures/>\n',
+              _list('Appliances', 'Appliance', appliances, '      '),
+              '      <ArchitectureStyle/>\n',
+              _element('RoomCount', len(rooms) if rooms else 0, '      '),
+              _list('Rooms', 'Room', rooms, '      '),
+              '      <Elevator>No</Elevator>\n',
+              '    </RichDetails>\n',
+              '  </Listing>\n']
+    return ''.join(parts)
+
+
+def generate_feed(f, listings, seed=0):
+    """
+    Writes a synthetic feed
+    :param f: a text file object to write to
+    :param listings: the number of listings
+    :param seed: the random seed. The same seed always produces the same feed
+    :returns: None
+    """
+    rng = random.Random(seed)
+    boards = {}
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<Listings>\n')
+    for number in range(listings):
+        f.write(listing(rng, number, boards))
+    f.write('</Listings>\n')
+
+
+def write_feed(filename, listings, seed=0):
+    """
+    Writes a synthetic feed to a file (see generate_feed)
+    """
+    with open(filename, 'w', encoding='utf-8', newline='\n') as f:
+        generate_feed(f, listings, seed=seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic Zillow feed')
+    parser.add_argument('output', help='the XML file to write')
+    parser.add_argument('listings', type=int, help='the number of listings')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed')
+    args = parser.parse_args()
+    write_feed(args.output, args.listings, seed=args.seed)
@@ -0,0 +1,210 @@
+"""
+Benchmarks extract -> transform -> load on synthetic feeds of increasing size (see generate_feed.py).
+
+Every size runs in a fresh process, so the memory it uses isn't hidden by an earlier, larger run. The pipeline is
+run with a Metrics object (see etl.Metrics) and each stage is reported with:
+    seconds         - its latency, the best of --repeat runs
+    rows_per_second - its throughput in that run
+    peak_rss_bytes  - how far the resident set size of the process rose above where it was when the stage started
+By default the feed is processed at once. --batch-size and --stream benchmark the other modes, and a baseline only
+compares against runs made with the same options. The results are written as JSON. With --baseline they are
+compared to an earlier run, and the script exits with 1 when a stage got slower, or used more memory, than
+--threshold allows.
+
+    $ python run_benchmarks.py --sizes 1000,10000 --output results.json
+    $ python run_benchmarks.py --baseline baseline.json --threshold 0.25
+    $ python run_benchmarks.py --output baseline.json    # record a new baseline
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import etl
+from generate_feed import write_feed
+
+STAGES = etl.Metrics.STAGES
+
+
+class RssSampler(object):
+    """
+    A Metrics hook that samples the resident set size while a stage runs and records how far it rose above where
+    it started. Reads /proc, so peak memory is only reported on Linux.
+    """
+    INTERVAL = 0.002
+
+    def __init__(self):
+        self.peaks = dict((stage, 0) for stage in STAGES)
+        self._page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self._stop = None
+
+    def rss(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self._page
+        except (IOError, OSError):
+            return None
+
+    def _sample(self, stage, start, stop):
+        peak = start
+        while not stop.wait(self.INTERVAL):
+            peak = max(peak, self.rss())
+        peak = max(peak, self.rss())
+        self.peaks[stage] = max(self.peaks[stage], peak - start)
+
+    def __call__(self, event, stage, metrics):
+        if stage is None or self.rss() is None:
+            return
+        if event == 'start':
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, args=(stage, self.rss(), self._stop))
+            self._thread.start()
+        elif event == 'end':
+            self._stop.set()
+            self._thread.join()
+
+
+def measure(filename, output, repeat, options):
+    """
+    Runs the pipeline on a feed repeat times. Runs in its own process (see run).
+    :param options: keyword arguments for run_pipeline, i.e. batch_size or stream
+    :returns: a dictionary of stage name to results
+    """
+    results = {}
+    for i in range(repeat):
+        sampler = RssSampler()
+        metrics = etl.Metrics(hooks=[sampler])
+        etl.run_pipeline(filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS, output, etl.ZILLOW_OUTPUT_COLUMNS,
+                         metrics=metrics, **options)
+        report = metrics.report()
+        for stage in STAGES:
+            current = dict(report['stages'][stage])
+            current['peak_rss_bytes'] = sampler.peaks[stage] if sampler.rss() is not None else None
+            best = results.get(stage)
+            if best is None or current['seconds'] < best['seconds']:
+                # Memory doesn't vary like time does, but keep the largest seen
+                if best is not None and best['peak_rss_bytes'] is not None:
+                    current['peak_rss_bytes'] = max(current['peak_rss_bytes'], best['peak_rss_bytes'])
+                results[stage] = current
+            elif best['peak_rss_bytes'] is not None:
+                best['peak_rss_bytes'] = max(best['peak_rss_bytes'], current['peak_rss_bytes'])
+    os.remove(output)
+    return results
+
+
+def run(sizes, repeat=3, feed_dir=None, seed=0, options=None):
+    """
+    Generates a feed of every size (kept in feed_dir when given) and benchmarks it in a fresh process
+    :param options: keyword arguments for run_pipeline, i.e. batch_size or stream
+    :returns: the results document
+    """
+    options = dict(options or {})
+    work_dir = tempfile.mkdtemp(prefix='etl_benchmarks_')
+    feed_dir = feed_dir or work_dir
+    document = {'machine' : {'platform' : platform.platform(), 'python' : platform.python_version(),
+                             'cpus' : etl.available_cpus()},
+                'repeat'  : repeat,
+                'seed'    : seed,
+                'options' : options,
+                'sizes'   : {}}
+    try:
+        for size in sizes:
+            filename = os.path.join(feed_dir, 'feed_%d_%d.xml' % (size, seed))
+            if not os.path.exists(filename):
+                write_feed(filename, size, seed=seed)
+            output = os.path.join(work_dir, 'out_%d.csv' % size)
+            context = multiprocessing.get_context('spawn')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                document['sizes'][str(size)] = executor.submit(measure, filename, output, repeat, options).result()
+            if feed_dir == work_dir:
+                os.remove(filename)
+    finally:
+        if not os.listdir(work_dir):
+            os.rmdir(work_dir)
+    return document
+
+
+def compare(results, baseline, threshold=0.25, memory_slack=16 << 20):
+    """
+    Compares results to a baseline. Only sizes and stages present in both are compared.
+    :param threshold: the fraction a stage may lose in throughput, or gain in peak memory, before it counts as a
+                      regression
+    :param memory_slack: bytes of extra memory that never count as a regression. Small runs are noisy
+    :returns: a list of regressions, one line each
+    """
+    regressions = []
+    if results.get('options') != baseline.get('options'):
+        return ["the baseline was run with different options: %s, now %s" % (
+            json.dumps(baseline.get('options')), json.dumps(results.get('options')))]
+    for size, stages in sorted(results['sizes'].items(), key=lambda item: int(item[0])):
+        for stage in STAGES:
+            current = stages.get(stage)
+            before = baseline.get('sizes', {}).get(size, {}).get(stage)
+            if current is None or before is None:
+                continue
+            if before['rows_per_second'] and current['rows_per_second'] is not None and \
+                    current['rows_per_second'] < before['rows_per_second'] * (1 - threshold):
+                regressions.append("%s rows %s: %.0f rows/s, baseline %.0f rows/s" % (
+                    size, stage, current['rows_per_second'], before['rows_per_second']))
+            if before['peak_rss_bytes'] is not None and current['peak_rss_bytes'] is not None and \
+                    current['peak_rss_bytes'] > before['peak_rss_bytes'] * (1 + threshold) + memory_slack:
+                regressions.append("%s rows %s: peak rss +%.1fMB, baseline +%.1fMB" % (
+                    size, stage, current['peak_rss_bytes'] / 1e6, before['peak_rss_bytes'] / 1e6))
+    return regressions
+
+
+def format_results(results):
+    """
+    :returns: the results as a table, one line per size and stage
+    """
+    lines = ["%10s  %-9s  %10s  %14s  %12s" % ('listings', 'stage', 'seconds', 'rows/s', 'peak rss MB')]
+    for size, stages in sorted(results['sizes'].items(), key=lambda item: int(item[0])):
+        for stage in STAGES:
+            current = stages[stage]
+            peak = current['peak_rss_bytes']
+            lines.append("%10s  %-9s  %10.4f  %14.0f  %12s" % (size, stage, current['seconds'],
+                                                                current['rows_per_second'] or 0,
+                                                                '-' if peak is None else "%.1f" % (peak / 1e6)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ETL pipeline on synthetic feeds')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated numbers of listings to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed of the synthetic feeds')
+    parser.add_argument('--batch-size', type=int, default=None, help='benchmark the batched pipeline')
+    parser.add_argument('--stream', action='store_true', help='benchmark streamed extraction')
+    parser.add_argument('--feed-dir', default=None, help='keep the generated feeds here and reuse them')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare the results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction of throughput a stage may lose, or of memory it may gain, against the '
+                             'baseline before the run fails')
+    args = parser.parse_args()
+
+    options = {}
+    if args.batch_size:
+        options['batch_size'] = args.batch_size
+    if args.stream:
+        options['stream'] = True
+    results = run([int(size) for size in args.sizes.split(',')], repeat=args.repeat, feed_dir=args.feed_dir,
+                  seed=args.seed, options=options)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True) + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), threshold=args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        sys.exit(1 if regressions else 0)
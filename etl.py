@@ -1,54 +1,795 @@
 import lxml
 from lxml import etree
+import argparse
+import array
+import collections
+import concurrent.futures
+import hashlib
+import http.client
+import itertools
+import json
+import mmap
+import multiprocessing
 import pandas as pd
 import numpy as np
+import os
+import re
+import shutil
+import signal
+import sqlite3
 import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+import zlib
+
+# Matches the strings that XPath's number() function accepts. Anything else converts to NaN.
+_XPATH_NUMBER = re.compile(r'^[ \t\r\n]*-?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?[ \t\r\n]*$')
+
+# Matches the XPath statements the ColumnExtractor can evaluate itself: an optional string() or number() wrapped
+# around a chain of element names (or *) ending in text()
+_SIMPLE_XPATH = re.compile(r'^(?:(string|number)\((.*)\)|(.*))$')
+_SIMPLE_STEP  = re.compile(r'^(\*|[A-Za-z_][\w.\-]*)$')
+
+
+
+def xpath_number(text):
+    """
+    Converts a string to a float the same way XPath's number() function does
+    :param text: the string to convert
+    :returns: a float, NaN if the string isn't a number
+    :raises: None
+    """
+    return float(text) if _XPATH_NUMBER.match(text) else np.nan
+
+
+
+def check_value(col, value):
+    """
+    Helper function that checks a value extracted for a column against the column's vtype
+    :param col: the column from the column spec
+    :param value: the value returned by the column's xpath
+    :returns: the value to store in the row. Empty scalars and lists are returned as NaN, lists are joined with a comma
+    :raises: TypeError
+    """
+    if col['vtype'] == 'scalar':
+        # if it's a scalar, just return it
+        if not isinstance(value, (str, bytes, float, int)):
+            raise TypeError("vtype doesn't match value. col name: " +col['name'] + " col vtype: " + col['vtype'] + " value: " + str(type(value)))
+        return value if value != '' else np.nan
+    elif col['vtype'] == 'list':
+        # if it's a list of sub nodes, join them with a comma, then return them as a string
+        if type(value) != list:
+            raise TypeError("vtype doesn't match value. col name: " +col['name'] + " col vtype: " + col['vtype'] + " value: " + str(type(value)))
+        return ",".join(value) if len(value) > 0 else np.nan
+
+
+
+class ColumnExtractor(object):
+    """
+    A column spec compiled once into a reusable extractor. Calling the extractor with a listing element returns the
+    row of values for that listing, exactly as evaluating each column's xpath against the listing would.
+    XPath statements of the form string(A/B/text()), number(A/B/text()) and A/B/*/text() are not evaluated by
+    libxml2. Instead their steps are merged into a single tree of element names and every listing is walked once,
+    handing the text nodes it meets to the columns that asked for them. Any other XPath statement is compiled into an
+    etree.XPath object and evaluated as before.
+    With isolate every column is compiled into its own etree.XPath, so the cost of each can be timed on its own (see
+    Metrics). It is slower, but the values are the same.
+    """
+
+    def __init__(self, cols, isolate=False):
+        """
+        :param cols: column spec (see extract_xml for details)
+        :param isolate: evaluate every column with its own XPath instead of a shared walk
+        :raises: lxml.etree.XPathSyntaxError, ValueError
+        """
+        self.columns = list(cols)
+        self.isolate = isolate
+        self.names = [col['name'] for col in self.columns]
+        for col in self.columns:
+            if col.get('dtype') not in ColumnBuffer.DTYPES:
+                raise ValueError("unsupported dtype. col name: " + col['name'] + " dtype: " + str(col.get('dtype')))
+            length = col.get('max_length')
+            if length is not None and (not isinstance(length, int) or length < 1):
+                raise ValueError("max_length must be a positive integer. col name: " + col['name'] + " max_length: "
+                                 + str(length))
+        # The index in columns of every value in a row
+        self.positions = [i for i, col in enumerate(self.columns) if col['vtype'] in ('scalar', 'list')]
+        # (position in the row, max_length) of the columns whose strings are truncated as they are extracted
+        self._truncate = [(i, self.columns[position]['max_length']) for i, position in enumerate(self.positions)
+                          if self.columns[position].get('max_length') is not None]
+        # Root of the step tree. Each node is a pair of (children keyed by step, [(column index, function)])
+        self._tree = ({}, [])
+        self._simple = []
+        self._xpaths = []
+        for i, col in enumerate(self.columns):
+            parsed = None if isolate else self._parse(col['xpath'])
+            if parsed is None:
+                self._xpaths.append((i, etree.XPath(col['xpath'], smart_strings=False)))
+                continue
+            func, steps = parsed
+            node = self._tree
+            for step in steps:
+                node = node[0].setdefault(step, ({}, []))
+            node[1].append((i, func))
+            self._simple.append((i, func))
+
+    @staticmethod
+    def _parse(xpath):
+        """
+        Splits a simple XPath statement into its function (string, number or None for a node set) and element steps
+        :returns: a (function, steps) tuple or None if the statement isn't simple
+        """
+        func, inner, bare = _SIMPLE_XPATH.match(xpath.strip()).groups()
+        steps = (inner if func else bare).strip().split('/')
+        if len(steps) < 2 or steps[-1] != 'text()':
+            return None
+        if not all(_SIMPLE_STEP.match(step) for step in steps[:-1]):
+            return None
+        return func, steps[:-1]
+
+    def _walk(self, elem, node, found):
+        """
+        Walks the children of elem that appear in the step tree, collecting the text nodes of matching elements in
+        document order.
+        """
+        children = node[0]
+        # Let lxml filter the children by tag so proxies are only created for elements we're interested in.
+        # Comments and processing instructions are never matched by an element step.
+        if '*' in children:
+            matches = elem.iterchildren(etree.Element)
+        else:
+            matches = elem.iterchildren(*children)
+        for child in matches:
+            for sub in (children.get(child.tag), children.get('*')):
+                if sub is None:
+                    continue
+                if sub[1]:
+                    # The text nodes of an element are its text followed by the tail of each of its children
+                    texts = [] if child.text is None else [child.text]
+                    if len(child):
+                        texts.extend(c.tail for c in child if c.tail is not None)
+                    for i, func in sub[1]:
+                        found[i].extend(texts)
+                if sub[0]:
+                    self._walk(child, sub, found)
+
+    @staticmethod
+    def _value(func, texts):
+        """
+        :returns: the value of a simple column from the text nodes the walk found for it
+        """
+        if func == 'string':
+            return texts[0] if texts else ''
+        if func == 'number':
+            return xpath_number(texts[0]) if texts else np.nan
+        return texts
+
+    def __call__(self, listing, timings=None):
+        """
+        :param listing: the lxml element for a single listing
+        :param timings: optional list of len(columns) + 1 floats (see Metrics.column_timings). The seconds spent on
+                        each column, from evaluating its XPath or converting what the walk found for it to checking
+                        and truncating its value, are added to its entry. The seconds spent on the shared walk of the
+                        simple columns go to the last entry
+        :returns: the list of values for the listing, one per column
+        :raises: TypeError
+        """
+        if timings is not None:
+            return self._timed(listing, timings)
+        values = [None] * len(self.columns)
+        if self._simple:
+            found = [[] for col in self.columns]
+            self._walk(listing, self._tree, found)
+            for i, func in self._simple:
+                values[i] = self._value(func, found[i])
+        for i, xpath in self._xpaths:
+            values[i] = xpath(listing)
+
+        row = []
+        for col, value in zip(self.columns, values):
+            if col['vtype'] in ('scalar', 'list'):
+                row.append(check_value(col, value))
+        for position, length in self._truncate:
+            value = row[position]
+            if isinstance(value, str) and len(value) > length:
+                row[position] = value[:length]
+        return row
+
+    def _timed(self, listing, timings):
+        """
+        __call__ with timings, column by column
+        """
+        clock = time.perf_counter
+        values = [None] * len(self.columns)
+        if self._simple:
+            found = [[] for col in self.columns]
+            start = clock()
+            self._walk(listing, self._tree, found)
+            timings[-1] += clock() - start
+            for i, func in self._simple:
+                start = clock()
+                values[i] = self._value(func, found[i])
+                timings[i] += clock() - start
+        for i, xpath in self._xpaths:
+            start = clock()
+            values[i] = xpath(listing)
+            timings[i] += clock() - start
+
+        lengths = dict(self._truncate)
+        row = []
+        for j, i in enumerate(self.positions):
+            start = clock()
+            value = check_value(self.columns[i], values[i])
+            length = lengths.get(j)
+            if length is not None and isinstance(value, str) and len(value) > length:
+                value = value[:length]
+            row.append(value)
+            timings[i] += clock() - start
+        return row
+
+
+
+def compile_columns(cols):
+    """
+    Compiles a column spec into a ColumnExtractor. Compiling once and reusing the extractor for every listing avoids
+    re-parsing each column's XPath statement for every record.
+    :param cols: column spec (see extract_xml for details) or an already compiled ColumnExtractor
+    :returns: a ColumnExtractor
+    :raises: lxml.etree.XPathSyntaxError
+    """
+    return cols if isinstance(cols, ColumnExtractor) else ColumnExtractor(cols)
+
+
+
+def project_columns(cols, needed, derived=None):
+    """
+    Narrows a column spec down to the columns needed to produce some others, so nothing else is extracted.
+    :param cols: column spec (see extract_xml for details) or a ColumnExtractor from compile_columns
+    :param needed: the names of the columns wanted once the data is transformed, i.e. the output columns
+    :param derived: dictionary of the columns the transform stage derives. Each maps to a dictionary of the columns
+                    it is computed from and how many characters of each it reads, None for all of them (see
+                    ZILLOW_DERIVED_COLUMNS)
+    :returns: a column spec holding only the needed columns, in their original order. A column that is only read
+              in part gets a max_length, so the rest of its text is dropped while extracting. A ColumnExtractor that
+              holds just the needed columns is returned as is
+    :raises: None
+    """
+    extractor = None
+    if isinstance(cols, ColumnExtractor):
+        extractor, cols = cols, cols.columns
+    derived = derived or {}
+    # Name of every needed column to the number of characters needed, None for the whole value
+    lengths = {}
+    def need(name, length):
+        if name in lengths:
+            length = None if lengths[name] is None or length is None else max(lengths[name], length)
+        lengths[name] = length
+    for name in needed:
+        need(name, None)
+        for source, length in derived.get(name, {}).items():
+            need(source, length)
+
+    projected = []
+    for col in cols:
+        if col['name'] not in lengths:
+            continue
+        length = lengths[col['name']]
+        if length is not None and (col.get('max_length') is None or col['max_length'] > length):
+            col = dict(col, max_length=length)
+        projected.append(col)
+    # An extractor that is already narrowed down is kept, rather than compiled again
+    if extractor is not None and projected == list(cols):
+        return extractor
+    return projected
+
+
 
 def get_rows(listings, cols):
     """
     A helper function for the extract_xml function. It returns a two dimenionsal array represnting the data set
     :param listings: collection of lxml objects represnting listings
-    :param cols: column spec (see extract_xml for details)
+    :param cols: column spec (see extract_xml for details) or a ColumnExtractor from compile_columns
     :returns: a two dimensional array of results. The first dimension are the rows. The second dimension are the
               columns
     :raises: TypeError
     """
+    extractor = compile_columns(cols)
     rows = []
     # Loop over each listing
     for child in listings:
-        row = []
-        # For each column that has been specified
-        for col in cols:
-            # Extract the element using the column's xpath
-            value = child.xpath(col['xpath'])
-            if col['vtype'] == 'scalar':
-                # if it's a scalar, just append it
-                if type(value) != lxml.etree._ElementUnicodeResult and \
-                   type(value) != lxml.etree._ElementStringResult and \
-                   type(value) != float and \
-                   type(value) != int:
-                    raise TypeError("vtype doesn't match value. col name: " +col['name'] + " col vtype: " + col['vtype'] + " value: " + str(type(value)))
-                row.append(value if value != '' else np.nan)
-            elif col['vtype'] == 'list':
-                # if it's a list of sub nodes, grab them, join them with a comma,
-                # then insert as a string
-                if type(value) != list:
-                    raise TypeError("vtype doesn't match value. col name: " +col['name'] + " col vtype: " + col['vtype'] + " value: " + str(type(value)))
-                row.append(",".join(value) if len(value) > 0 else np.nan)
-
+        row = extractor(child)
         if(len(row) > 0):
             rows.append(row)
     return rows
 
 
 
-def extract_xml(filename, columns, path_to_listings):
+class ColumnBuffer(object):
+    """
+    A growable, typed buffer holding the values of a single column while listings are being extracted. Typed
+    buffers store raw machine values (or dictionary codes) instead of one Python object per cell, and are turned
+    into a NumPy/Pandas array without having to infer their type afterwards.
+    Supported dtypes:
+        None       - no conversion, the type is inferred by Pandas as for get_rows
+        'float64'  - NaN for missing values
+        'Int64'    - integers with missing values (Pandas' nullable integer type)
+        'category' - dictionary encoded strings, a good fit for low cardinality fields like states or MLS names
+        'string'   - Pandas' string type
+    """
+
+    DTYPES = (None, 'float64', 'Int64', 'category', 'string')
+
+    def __init__(self, col):
+        """
+        :param col: the column from the column spec
+        :raises: ValueError
+        """
+        self.name = col['name']
+        self.dtype = col.get('dtype')
+        if self.dtype not in self.DTYPES:
+            raise ValueError("unsupported dtype. col name: " + self.name + " dtype: " + str(self.dtype))
+        if self.dtype == 'float64':
+            self.values = array.array('d')
+        elif self.dtype == 'Int64':
+            self.values = array.array('q')
+            self.mask = bytearray()
+        elif self.dtype == 'category':
+            self.values = array.array('i')
+            self.codes = {}
+        else:
+            self.values = []
+
+    def _number(self, value):
+        """
+        Converts a scalar to a float. Missing values (NaN) are returned as is.
+        """
+        if isinstance(value, float):
+            return value
+        try:
+            return float(value)
+        except ValueError:
+            raise TypeError("dtype doesn't match value. col name: " + self.name + " dtype: " + self.dtype + " value: " + repr(value))
+
+    def append(self, value):
+        """
+        Appends a value, as returned by check_value, to the buffer
+        :raises: TypeError
+        """
+        if self.dtype == 'float64':
+            self.values.append(self._number(value))
+        elif self.dtype == 'Int64':
+            number = self._number(value)
+            if number != number:
+                self.values.append(0)
+                self.mask.append(1)
+            elif number.is_integer():
+                self.values.append(int(number))
+                self.mask.append(0)
+            else:
+                raise TypeError("dtype doesn't match value. col name: " + self.name + " dtype: " + self.dtype + " value: " + repr(value))
+        elif self.dtype == 'category':
+            if isinstance(value, float) and value != value:
+                self.values.append(-1)
+            else:
+                self.values.append(self.codes.setdefault(value, len(self.codes)))
+        elif self.dtype == 'string':
+            self.values.append(None if isinstance(value, float) and value != value else str(value))
+        else:
+            self.values.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, other):
+        """
+        Appends the values of another buffer for the same column, i.e. one filled by a different shard of the feed
+        :param other: a ColumnBuffer with the same dtype
+        """
+        if self.dtype == 'category':
+            # Re-map the other buffer's codes onto ours. Missing values (-1) pick up the extra -1 at the end.
+            mapping = [self.codes.setdefault(value, len(self.codes)) for value in other.codes]
+            codes = np.array(mapping + [-1], dtype=np.int32)[np.frombuffer(other.values, dtype=np.int32)]
+            self.values.frombytes(codes.tobytes())
+        else:
+            self.values.extend(other.values)
+            if self.dtype == 'Int64':
+                self.mask.extend(other.mask)
+
+    def to_array(self):
+        """
+        :returns: the buffer as a NumPy array or Pandas extension array, or a list when the dtype is to be inferred
+        """
+        if self.dtype == 'float64':
+            return np.frombuffer(self.values, dtype=np.float64)
+        elif self.dtype == 'Int64':
+            return pd.arrays.IntegerArray(np.frombuffer(self.values, dtype=np.int64),
+                                          np.frombuffer(self.mask, dtype=np.bool_))
+        elif self.dtype == 'category':
+            return pd.Categorical.from_codes(np.frombuffer(self.values, dtype=np.int32), categories=list(self.codes))
+        elif self.dtype == 'string':
+            return pd.array(self.values, dtype='string')
+        return self.values
+
+
+
+def get_columns(listings, cols, timings=None):
+    """
+    A helper function for the extract_xml function. It fills a typed buffer per column (see ColumnBuffer) while
+    walking the listings, so the result can be turned into a DataFrame column by column without pivoting rows.
+    :param listings: collection of lxml objects represnting listings
+    :param cols: column spec (see extract_xml for details) or a ColumnExtractor from compile_columns
+    :param timings: optional list to add the time spent on each column to (see ColumnExtractor.__call__),
+                    including the time spent appending its values to its buffer
+    :returns: a list of ColumnBuffers, one per column
+    :raises: TypeError, ValueError
+    """
+    extractor = compile_columns(cols)
+    buffers = [ColumnBuffer(col) for col in extractor.columns if col['vtype'] in ('scalar', 'list')]
+    if timings is not None:
+        clock = time.perf_counter
+        for child in listings:
+            row = extractor(child, timings)
+            for buf, value, i in zip(buffers, row, extractor.positions):
+                start = clock()
+                buf.append(value)
+                timings[i] += clock() - start
+        return buffers
+    # Loop over each listing
+    for child in listings:
+        row = extractor(child, timings)
+        for buf, value in zip(buffers, row):
+            buf.append(value)
+    return buffers
+
+
+
+def frame_from_columns(buffers):
+    """
+    Builds a DataFrame from the buffers returned by get_columns
+    :param buffers: list of ColumnBuffers
+    :returns: a Pandas Dataframe with one column per buffer
+    :raises: None
+    """
+    df = pd.DataFrame(dict(enumerate(buf.to_array() for buf in buffers)), columns=range(len(buffers)))
+    df.columns = [buf.name for buf in buffers]
+    return df
+
+
+
+def _open_source(filename):
+    """
+    A helper function for the extract functions. lxml only reads local files, so a url is opened with urllib and
+    read as a file object (see open_feed for fetching feeds with a cache).
+    :param filename: url, filename or file object
+    :returns: a file object for a url, anything else as is
+    :raises: IOError
+    """
+    if isinstance(filename, str) and re.match(r'^https?://', filename):
+        return urllib.request.urlopen(filename)
+    return filename
+
+
+
+def iter_listings(filename, path_to_listings):
+    """
+    A helper function for the extract_xml function. It walks the document incrementally with iterparse and yields
+    each listing element as soon as it has been fully read. Once the consumer asks for the next listing, the previous
+    one is cleared and detached from the tree so memory stays flat regardless of the size of the file.
+    Only simple element paths are supported (i.e. '/Listings/Listing', 'Listing' or '/Listings/*'). Relative paths
+    are evaluated from the root element, the same way root.xpath() would evaluate them.
+    :param filename: url, filename or file object
+    :param path_to_listings: the XPath to the listing records (see extract_xml for details)
+    :returns: a generator of lxml elements
+    :raises: ValueError, IOError, lxml.etree.XMLSyntaxError
+    """
+    absolute = path_to_listings.startswith('/')
+    steps = path_to_listings.strip('/').split('/')
+    for step in steps:
+        if step != '*' and not re.match(r'^[A-Za-z_][\w.\-]*$', step):
+            raise ValueError("streaming extract only supports simple element paths. path: " + path_to_listings)
+
+    tag = None if steps[-1] == '*' else steps[-1]
+
+    source = _open_source(filename)
+    try:
+        for event, elem in etree.iterparse(source, events=('end',), tag=tag):
+            # Walk up the ancestors and make sure the element sits at the requested path
+            node, matched = elem, True
+            for step in reversed(steps):
+                if node is None or (step != '*' and node.tag != step):
+                    matched = False
+                    break
+                node = node.getparent()
+            # An absolute path starts at the root element, a relative one starts just below it
+            if absolute:
+                matched = matched and node is None
+            else:
+                matched = matched and node is not None and node.getparent() is None
+            if not matched:
+                continue
+
+            yield elem
+
+            # The consumer has pulled everything it needs from this listing. Free it, along with any siblings that
+            # preceded it, so the partially built tree never grows beyond a single listing.
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+    finally:
+        if source is not filename:
+            source.close()
+
+
+
+# Idle HTTP connections, keyed on (scheme, host, port), so feeds from the same server reuse them
+_connections = {}
+
+
+
+def _http_get(url, headers, redirects=5):
+    """
+    Helper function for open_feed. Issues a GET over a pooled keep-alive connection, following redirects. The
+    connection is taken out of the pool until the response has been read (see _release).
+    :returns: a (connection key, connection, http.client.HTTPResponse) tuple
+    :raises: IOError
+    """
+    for i in range(redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        request_headers = dict(headers, Host=parts.netloc)
+        for attempt in range(2):
+            connection = _connections.pop(key, None)
+            if connection is None:
+                if parts.scheme == 'https':
+                    connection = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=60)
+                elif parts.scheme == 'http':
+                    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+                else:
+                    raise IOError("unsupported url scheme. url: " + url)
+            try:
+                connection.request('GET', path, headers=request_headers)
+                response = connection.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # The server closed an idle keep-alive connection. Retry once on a fresh one.
+                connection.close()
+                if attempt == 1:
+                    raise
+
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            response.read()
+            _release(key, connection, response)
+            url = urllib.parse.urljoin(url, response.getheader('Location'))
+            continue
+        return key, connection, response
+    raise IOError("too many redirects. url: " + url)
+
+
+
+def _release(key, connection, response):
+    """
+    Helper function for open_feed. Returns a connection whose response has been read in full to the pool, unless
+    the server asked to close it.
+    """
+    response.close()
+    if response.will_close:
+        connection.close()
+    else:
+        _connections[key] = connection
+
+
+
+def _open_aside(path, mode):
+    """
+    Helper function for the fetch layer. Opens a new file to write path through, next to it under a name of its own,
+    so jobs sharing a cache directory never write to the same temporary file.
+    :returns: the file object and its path
+    """
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    return os.fdopen(fd, mode), tmp
+
+
+def _write_json(path, document):
+    """
+    Helper function for the fetch layer. Writes a JSON file aside and renames it into place.
+    """
+    f, tmp = _open_aside(path, 'w')
+    with f:
+        json.dump(document, f)
+    os.replace(tmp, path)
+
+
+
+class CachedFeed(object):
+    """
+    A file-like object returned by open_feed. Reading it streams the body of the response, un-gzipping it on the
+    fly, so the XML parser can start while bytes are still arriving. Everything read is also written to the cache;
+    once the body has been read to the end the cached copy and its ETag/Last-Modified validators are committed.
+    The validators are only recorded against the output by commit(), once the output has been loaded from the feed.
+    """
+
+    def __init__(self, key, connection, response, body_path, meta_path, meta, state_path=None):
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._body_path = body_path
+        self._meta_path = meta_path
+        self._meta = meta
+        self._state_path = state_path
+        self._cache, self._tmp = _open_aside(body_path, 'wb')
+        self._done = False
+        self._complete = False
+        gzipped = (response.getheader('Content-Encoding') or '').lower() in ('gzip', 'x-gzip')
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        """
+        :returns: up to size bytes of the (uncompressed) feed, b'' at the end. Everything that's left if size is
+                  negative
+        """
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(65536), b''))
+        data = b''
+        while not data and not self._done:
+            chunk = self._response.read(size)
+            self.bytes_read += len(chunk)
+            if self._decompressor is None:
+                data = chunk
+            else:
+                data = self._decompressor.decompress(chunk)
+                if not chunk:
+                    data += self._decompressor.flush()
+            self._cache.write(data)
+            if not chunk:
+                self._finish()
+        return data
+
+    def _finish(self):
+        """
+        Commits the cached copy once the whole body has been read
+        """
+        self._done = True
+        self._complete = True
+        self._cache.close()
+        os.replace(self._tmp, self._body_path)
+        _write_json(self._meta_path, self._meta)
+        _release(self._key, self._connection, self._response)
+
+    def commit(self):
+        """
+        Records that the output now holds this version of the feed, so the next run can skip it while the feed is
+        unchanged. Call it once the output has been loaded. A feed that wasn't read to the end isn't recorded.
+        """
+        if self._complete and self._state_path is not None:
+            _write_json(self._state_path, self._meta)
+
+    def close(self):
+        """
+        Closes the response. A body that wasn't read to the end is dropped from the cache, along with the
+        connection it was arriving on.
+        """
+        if not self._done and self._response.length == 0:
+            # Every byte arrived but the parser stopped before asking for the end of the body
+            self.read()
+        if not self._done:
+            self._done = True
+            self._cache.close()
+            os.remove(self._tmp)
+            self._response.close()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+class StoredFeed(object):
+    """
+    A file-like object returned by open_feed when the feed hasn't changed since it was cached, but the output wasn't
+    loaded from the cached copy (i.e. it was deleted, or another output brought the cache up to date). Reading it
+    reads the cached copy. commit() records the validators against the output, as CachedFeed.commit does.
+    """
+
+    def __init__(self, body_path, meta, state_path):
+        self._file = open(body_path, 'rb')
+        self._meta = meta
+        self._state_path = state_path
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def commit(self):
+        _write_json(self._state_path, self._meta)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def open_feed(url, cache_dir, conditional=True, output=None):
+    """
+    A fetch layer in front of the extract function for remote feeds. The feed is requested with gzip compression
+    over a reused connection. When a copy is cached the request is conditional (If-None-Match/If-Modified-Since) and
+    a 304 means the feed hasn't changed since it was cached.
+    With an output, the validators of the version the output was last loaded from are kept for that output alone
+    (see CachedFeed.commit), so several outputs can be fed from the same url. A 304 then only skips the feed when the
+    output exists and was loaded from the cached copy. Otherwise the cached copy is returned, and nothing is
+    downloaded again.
+    :param url: the feed url
+    :param cache_dir: the directory to cache feeds and their validators in. It is created if it doesn't exist
+    :param conditional: send the cached validators. Pass False to always get the body
+    :param output: the output the feed is loaded into, or None
+    :returns: a CachedFeed or StoredFeed to hand to extract_xml in place of the url, or None if the feed (without an
+              output) or the output (with one) is up to date
+    :raises: IOError
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    name = hashlib.sha1(url.encode()).hexdigest()
+    body_path = os.path.join(cache_dir, name + '.xml')
+    meta_path = os.path.join(cache_dir, name + '.json')
+    state_path = None
+    if output is not None:
+        state_path = os.path.join(cache_dir, name + '.' + hashlib.sha1(os.path.abspath(output).encode()).hexdigest()
+                                  + '.json')
+
+    headers = {'Accept-Encoding' : 'gzip'}
+    cached = None
+    if conditional and os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cached = json.load(f)
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    key, connection, response = _http_get(url, headers)
+    if response.status != 200:
+        response.read()
+        _release(key, connection, response)
+        if response.status == 304 and cached is not None:
+            if state_path is None:
+                return None
+            loaded = None
+            if os.path.exists(output) and os.path.exists(state_path):
+                with open(state_path) as f:
+                    loaded = json.load(f)
+            if loaded == cached:
+                return None
+            return StoredFeed(body_path, cached, state_path)
+        raise IOError("failed to fetch feed. url: " + url + " status: " + str(response.status))
+
+    meta = {'url' : url, 'etag' : response.getheader('ETag'), 'last_modified' : response.getheader('Last-Modified')}
+    return CachedFeed(key, connection, response, body_path, meta_path, meta, state_path)
+
+
+
+def extract_xml(filename, columns, path_to_listings, stream=False, metrics=None):
     """
     The extract function in our ETL process. It takes an xml file as input and returns a Pandas Dataframe.
     This function was designed to be flexible enough to support multiple XML Schema. The Dataframe returned 
     will be consist across schema as long as the proper column spec is provided for that schema.
     :param filename: url or filename
-    :param columns: The column spec is an array of dictionaries. Each dictionary must have the following fields:
+    :param columns: The column spec is an array of dictionaries (or a ColumnExtractor compiled from one with
+                    compile_columns). Each dictionary must have the following fields:
                         name - the column name for the Dataframe
                         xpath - the XPath statement used to extract the data element from the XML. For scalars the
                                 XPath statement must return a single scalar value. For lists, the XPath statement must
@@ -57,6 +798,13 @@ def extract_xml(filename, columns, path_to_listings):
                                 returned Dataframe as they are read from the file. Their type will be inferred by 
                                 Pandas. Lists will have their elements concatenated with a comma and then be inserted 
                                 into the dataframe as a string (dtype object)
+                    and may have the following optional field:
+                        dtype - the type of the column in the returned Dataframe. One of float64, Int64 (integers
+                                with missing values), category (dictionary encoded strings) or string. Values are
+                                converted while the file is read. When omitted the type is inferred by Pandas.
+                        max_length - keep only the first max_length characters of every string in the column. The
+                                     rest is dropped as soon as it's read, so long text that is only needed in part
+                                     is never held in the Dataframe (see project_columns).
     :path_to_listings: the XPath to the listing records i.e. if the XML doc has the structure
                             <Listings>
                                 <Listing>
@@ -65,15 +813,413 @@ def extract_xml(filename, columns, path_to_listings):
                                 </Listing>
                             </Listings>
                         the path_to_listings would be '/Listings/Listing'.
+    :param stream: when True the document is walked incrementally (see iter_listings) instead of being loaded into
+                   a single tree, so memory use stays flat regardless of the size of the feed. path_to_listings must
+                   then be a simple element path.
+    :param metrics: optional Metrics to add the time spent on each column to
     :returns: A Pandas Dataframe with the column names from the spec provided
-    :raises TypeError
+    :raises TypeError, ValueError, IOError
     """
         
-    tree = etree.parse(filename)
-    root = tree.getroot()
-    rows = get_rows(root.xpath(path_to_listings), columns)
+    extractor = compile_columns(columns)
+    timings = None
+    if metrics is not None:
+        extractor, timings = metrics.column_timings(extractor)
+    if stream:
+        buffers = get_columns(iter_listings(filename, path_to_listings), extractor, timings)
+    else:
+        source = _open_source(filename)
+        try:
+            tree = etree.parse(source)
+        finally:
+            if source is not filename:
+                source.close()
+        root = tree.getroot()
+        buffers = get_columns(root.xpath(path_to_listings), extractor, timings)
+
+    return frame_from_columns(buffers)
+
+
+
+def _outside_markup(data, pos):
+    """
+    Helper function for find_shards. Checks that a position in an XML document isn't inside a CDATA section or a
+    comment. CDATA sections and comments can't nest, so it's enough to look at the last one opened before pos.
+    """
+    cdata = data.rfind(b'<![CDATA[', 0, pos)
+    if cdata != -1 and data.find(b']]>', cdata, pos) == -1:
+        return False
+    comment = data.rfind(b'<!--', 0, pos)
+    if comment != -1 and data.find(b'-->', comment, pos) == -1:
+        return False
+    return True
+
+
+
+def find_shards(filename, path_to_listings, shards):
+    """
+    Splits a local XML file into byte ranges that each hold a run of complete listings. Every range starts at a
+    listing's start tag, skipping any that appear inside CDATA sections (i.e. a Description) or comments.
+    Only paths of the form '/Root/Listing' can be sharded.
+    :param filename: the XML filename
+    :param path_to_listings: the XPath to the listing records (see extract_xml for details)
+    :param shards: the number of shards wanted
+    :returns: a (head, ranges, tail) tuple, where head is the offset of the first listing, ranges is a list of
+              (start, end) offsets and tail is the offset of the root element's end tag. Each shard can be parsed
+              on its own by wrapping it with the head and the tail of the file. None if the file can't be sharded.
+    :raises: IOError
+    """
+    steps = path_to_listings.split('/')
+    if len(steps) != 3 or steps[0] != '' or not all(re.match(r'^[A-Za-z_][\w.\-]*$', step) for step in steps[1:]):
+        return None
+    root_tag, listing_tag = steps[1].encode(), steps[2].encode()
+    start_tag = re.compile(b'<' + re.escape(listing_tag) + b'[\\s/>]')
+
+    def next_listing(data, pos, end):
+        match = start_tag.search(data, pos, end)
+        while match is not None and not _outside_markup(data, match.start()):
+            match = start_tag.search(data, match.end(), end)
+        return None if match is None else match.start()
+
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            tail = data.rfind(b'</' + root_tag)
+            head = next_listing(data, 0, tail) if tail != -1 else None
+            if head is None:
+                return None
 
-    return pd.DataFrame(rows,columns=[col['name'] for col in columns])
+            # Aim for equal sized shards, then move each cut forward to the next listing
+            cuts = [head]
+            for i in range(1, shards):
+                cut = next_listing(data, max(head + (tail - head) * i // shards, cuts[-1] + 1), tail)
+                if cut is None:
+                    break
+                cuts.append(cut)
+            cuts.append(tail)
+        finally:
+            data.close()
+
+    return head, list(zip(cuts[:-1], cuts[1:])), tail
+
+
+
+def _extract_shard(args):
+    """
+    Worker for extract_xml_parallel. Parses a single shard (see find_shards) and extracts its listings.
+    :returns: a list of ColumnBuffers
+    """
+    filename, head, start, end, tail, columns, path_to_listings = args
+    with open(filename, 'rb') as f:
+        data = f.read(head)
+        f.seek(start)
+        data += f.read(end - start)
+        f.seek(tail)
+        data += f.read()
+    root = etree.fromstring(data)
+    return get_columns(root.xpath(path_to_listings), columns)
+
+
+
+def extract_xml_parallel(filename, columns, path_to_listings, processes=None, min_shard_bytes=1 << 20):
+    """
+    A parallel version of the extract function for local files. The file is split into shards at listing boundaries
+    (see find_shards), every shard is parsed and extracted in a separate process and the results are stitched
+    back together in their original order. The Dataframe returned is identical to the one extract_xml returns.
+    Falls back to extract_xml when the file can't be sharded, i.e. for urls, paths other than '/Root/Listing' or
+    files smaller than min_shard_bytes per process.
+    :param filename: the XML filename
+    :param columns: column spec (see extract_xml for details)
+    :param path_to_listings: the XPath to the listing records (see extract_xml for details)
+    :param processes: the number of worker processes. Defaults to the number of available cores
+    :param min_shard_bytes: the smallest shard worth handing to another process
+    :returns: A Pandas Dataframe with the column names from the spec provided
+    :raises: TypeError, ValueError, lxml.etree.XMLSyntaxError
+    """
+    extractor = compile_columns(columns)
+    processes = processes or available_cpus()
+    sharded = None
+    if processes > 1 and isinstance(filename, str) and os.path.isfile(filename):
+        shards = min(processes, os.path.getsize(filename) // max(min_shard_bytes, 1))
+        if shards > 1:
+            sharded = find_shards(filename, path_to_listings, shards)
+    if sharded is None or len(sharded[1]) < 2:
+        return extract_xml(filename, extractor, path_to_listings)
+
+    head, ranges, tail = sharded
+    jobs = [(filename, head, start, end, tail, extractor.columns, path_to_listings) for start, end in ranges]
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(processes, len(jobs))) as executor:
+            parts = list(executor.map(_extract_shard, jobs))
+    except etree.XMLSyntaxError:
+        # A shard didn't parse on its own (i.e. a listing tag nested deeper in the document). Parse the file
+        # serially, which either works or raises the real error.
+        return extract_xml(filename, extractor, path_to_listings)
+
+    buffers = parts[0]
+    for part in parts[1:]:
+        for buf, other in zip(buffers, part):
+            buf.extend(other)
+    return frame_from_columns(buffers)
+
+
+
+def iter_extract_xml(filename, columns, path_to_listings, batch_size, metrics=None):
+    """
+    A batched version of the extract function. The feed is streamed (see iter_listings) and a DataFrame is yielded
+    for every batch_size listings, so only a single batch is ever held in memory.
+    :param filename: url, filename or file object
+    :param columns: column spec (see extract_xml for details)
+    :param path_to_listings: the XPath to the listing records (see extract_xml for details)
+    :param batch_size: the maximum number of listings per DataFrame
+    :param metrics: optional Metrics to add the time spent on each column to
+    :returns: a generator of Pandas Dataframes with the column names from the spec provided. A feed without any
+              listings yields a single empty Dataframe so the consumer always sees the columns.
+    :raises: TypeError, ValueError
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1. batch_size: " + str(batch_size))
+
+    extractor = compile_columns(columns)
+    timings = None
+    if metrics is not None:
+        extractor, timings = metrics.column_timings(extractor)
+    listings = iter_listings(filename, path_to_listings)
+    batches = 0
+    while True:
+        buffers = get_columns(itertools.islice(listings, batch_size), extractor, timings)
+        size = len(buffers[0]) if buffers else 0
+        if size == 0 and batches > 0:
+            break
+        yield frame_from_columns(buffers)
+        batches += 1
+        if size < batch_size:
+            break
+
+
+
+class ExtractCache(object):
+    """
+    A persistent cache of extracted DataFrames, so a feed that has already been extracted with a spec doesn't have to
+    be parsed again. Entries are keyed on a hash of the file's contents plus the column spec and path to the listings,
+    so changing either one misses the cache. The content hash of a file is remembered along with its size and
+    modification time, and only recomputed when one of those changes.
+    Every entry is a directory holding one file per column:
+        float64 and Int64 columns - .npy files (values, and a mask of missing values for Int64)
+        category columns          - the codes as a .npy file, the categories in the entry's meta.json
+        string columns            - the UTF-8 text of the column in one file, plus the character offset of every
+                                    value and a mask of missing values
+    Numeric arrays are memory mapped straight into the DataFrame and the text is decoded in one go, so loading an
+    entry takes a fraction of the time parsing the feed does. Columns holding anything else (i.e. a mix of strings
+    and numbers) can't be stored, and such frames are simply not cached.
+    When the entries take more than max_bytes, the least recently used ones are evicted.
+    """
+    FORMAT = 1
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        """
+        :param directory: the directory holding the cache. It is created if it doesn't exist
+        :param max_bytes: the size the cache is kept under
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _content_hash(self, filename):
+        """
+        :returns: the SHA-1 of the file's contents, remembered by path, size and modification time
+        """
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        sources_path = os.path.join(self.directory, 'sources.json')
+        try:
+            with open(sources_path) as f:
+                sources = json.load(f)
+        except (IOError, ValueError):
+            sources = {}
+        known = sources.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        sources[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        # Written aside and renamed, so concurrent runs never see half a file. At worst one of them hashes again
+        tmp = sources_path + '.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(sources, f)
+        os.replace(tmp, sources_path)
+        return digest.hexdigest()
+
+    def key(self, filename, columns, path_to_listings):
+        """
+        :returns: the cache key for extracting a file with a spec
+        """
+        if isinstance(columns, ColumnExtractor):
+            columns = columns.columns
+        spec = json.dumps([self.FORMAT, pd.__version__, list(columns), path_to_listings], sort_keys=True)
+        return hashlib.sha1((self._content_hash(filename) + spec).encode()).hexdigest()
+
+    def load(self, key):
+        """
+        :returns: the cached DataFrame, or None when the key isn't cached
+        """
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        arrays = []
+        for i, col in enumerate(meta['columns']):
+            path = os.path.join(entry, str(i))
+            if col['kind'] == 'float64':
+                arrays.append(np.load(path + '.values.npy', mmap_mode='r'))
+            elif col['kind'] == 'Int64':
+                arrays.append(pd.arrays.IntegerArray(np.load(path + '.values.npy', mmap_mode='r'),
+                                                     np.load(path + '.mask.npy', mmap_mode='r')))
+            elif col['kind'] == 'category':
+                arrays.append(pd.Categorical.from_codes(np.load(path + '.values.npy', mmap_mode='r'),
+                                                        categories=col['categories']))
+            else:
+                with open(path + '.text', 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                            text = str(data, 'utf-8')
+                    else:
+                        text = ''
+                offsets = np.load(path + '.offsets.npy').tolist()
+                values = [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+                missing = None if col['kind'] == 'string' else np.nan
+                for row in np.flatnonzero(np.load(path + '.mask.npy')).tolist():
+                    values[row] = missing
+                # Built the same way as the extracted column, so Pandas infers the same dtype
+                arrays.append(pd.array(values, dtype='string') if col['kind'] == 'string' else values)
+
+        df = pd.DataFrame(dict(enumerate(arrays)), columns=range(len(arrays)), copy=False)
+        df.columns = [col['name'] for col in meta['columns']]
+        # The entry was just used, which is what eviction goes by
+        os.utime(os.path.join(entry, 'meta.json'))
+        return df
+
+    @staticmethod
+    def _kind(series):
+        """
+        :returns: how a column is stored, None when it can't be
+        """
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            return 'category'
+        if isinstance(dtype, pd.StringDtype):
+            return 'string' if dtype.na_value is pd.NA else 'text'
+        if str(dtype) == 'Int64':
+            return 'Int64'
+        if dtype == np.float64:
+            return 'float64'
+        if dtype == object and all(isinstance(value, str) for value in series[series.notnull()]):
+            return 'text'
+        return None
+
+    def store(self, key, df):
+        """
+        Stores a DataFrame and evicts old entries if the cache has grown too large
+        :returns: True if the DataFrame was stored
+        """
+        kinds = [self._kind(df[col]) for col in df.columns]
+        if None in kinds or len(set(df.columns)) != len(df.columns):
+            return False
+        entry = os.path.join(self.directory, key)
+        tmp = entry + '.tmp.' + str(os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        meta = {'format' : self.FORMAT, 'rows' : len(df), 'columns' : []}
+        for i, (name, kind) in enumerate(zip(df.columns, kinds)):
+            path = os.path.join(tmp, str(i))
+            series = df[name]
+            col = {'name' : name, 'kind' : kind}
+            if kind == 'float64':
+                np.save(path + '.values.npy', series.to_numpy())
+            elif kind == 'Int64':
+                np.save(path + '.values.npy', series.array._data)
+                np.save(path + '.mask.npy', series.array._mask)
+            elif kind == 'category':
+                np.save(path + '.values.npy', series.cat.codes.to_numpy())
+                col['categories'] = series.cat.categories.tolist()
+            else:
+                mask = series.isnull().to_numpy()
+                values = series.astype(object).where(~mask, '').tolist()
+                offsets = np.zeros(len(values) + 1, dtype=np.int64)
+                np.cumsum([len(value) for value in values], out=offsets[1:])
+                with open(path + '.text', 'wb') as f:
+                    f.write(''.join(values).encode('utf-8'))
+                np.save(path + '.offsets.npy', offsets)
+                np.save(path + '.mask.npy', mask)
+            meta['columns'].append(col)
+        # meta.json goes last. An entry without one is never loaded
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another run stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return True
+
+    def entries(self):
+        """
+        :returns: a list of (last used, bytes, path) for every entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            meta = os.path.join(entry, 'meta.json')
+            if '.tmp.' in name or not os.path.isfile(meta):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, part)) for part in os.listdir(entry))
+            entries.append((os.path.getmtime(meta), size, entry))
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes
+        """
+        entries = self.entries()
+        total = sum(size for used, size, entry in entries)
+        for used, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def extract(self, filename, columns, path_to_listings, stream=False, processes=None):
+        """
+        extract_xml through the cache. A miss extracts the file (in parallel when processes > 1, see
+        extract_xml_parallel) and stores the result.
+        :param filename: a local filename
+        :returns: A Pandas Dataframe, the same one extract_xml would return
+        :raises: TypeError, ValueError, IOError, lxml.etree.XMLSyntaxError
+        """
+        key = self.key(filename, columns, path_to_listings)
+        df = self.load(key)
+        if df is not None:
+            self.hits += 1
+            return df
+        self.misses += 1
+        if processes is not None and processes > 1:
+            df = extract_xml_parallel(filename, columns, path_to_listings, processes=processes)
+        else:
+            df = extract_xml(filename, columns, path_to_listings, stream=stream)
+        self.store(key, df)
+        return df
 
 
 
@@ -96,108 +1242,1478 @@ def bathroom_counter(row):
 
 
 
-def transform(df):
+def transform(df, engine='vectorized'):
     """
     This is the transform function for the Zillow data set. It transforms a data frame from the raw form extracted in
     the extract_xml function into the form that the CSV calls for.
-    :param: df -- the dataframe to transform. This dataframe MUST have the following columns:
-                     StreetAddress
-                     Bathrooms_raw - the bathrooms field extracted directly from the XML
-                     FullBathrooms
-                     HalfBathrooms
-                     ThreeQuarterBathrooms
-                     Full_Description
-                     Appliances
-                     Rooms
+    :param: df -- the dataframe to transform. Each derived column is computed when the columns it is derived from
+                  (see ZILLOW_DERIVED_COLUMNS) are in the dataframe, and skipped otherwise:
+                     Bathrooms   - Bathrooms_raw (the bathrooms field extracted directly from the XML),
+                                   FullBathrooms, HalfBathrooms and ThreeQuarterBathrooms
+                     Description - Full_Description. Only its first 200 characters are read, so it may have been
+                                   truncated while extracting (see project_columns)
+    :param: engine -- 'vectorized' computes the derived columns with whole column operations. 'rowwise' is the
+                      original implementation built on apply and bathroom_counter. Both produce identical frames.
     :returns: a transformed dataframe. 
                 NaNs filled in with '' for all string values
                 'Bathrooms' filled in with either the value directly from the XML or a computed value where 
-                            each full, quarter and half bath counts as ONE bathroom
+                            each full, quarter and half bath counts as ONE bathroom. Always a float, so the
+                            output doesn't depend on which listings happen to be in the frame
                 'Description' contains the Description truncated to 200 characters
-    :raises: None
+    :raises: ValueError
     """
+    if engine not in ('vectorized', 'rowwise'):
+        raise ValueError("unknown transform engine: " + str(engine))
+
     # Fill in nan values
     #df['Rooms']               = df['Rooms'].fillna('')
     #df['Appliances']          = df['Appliances'].fillna('')
-    df['Full_Description']    = df['Full_Description'].fillna('')
-    df['StreetAddress']       = df['StreetAddress'].fillna('')
+    if 'Full_Description' in df:
+        df['Full_Description']    = df['Full_Description'].fillna('')
+    if 'StreetAddress' in df:
+        df['StreetAddress']       = df['StreetAddress'].fillna('')
     
     # Calculate the number of bathroooms based on the half, full and quarter bath fields. Our logic will be to sum 
     # them together to get the total of bathrooms. Note that each full, quarter and half bath counts as ONE bathroom. 
     # In other words, a bathroom is any room with toilet. This is largely for simplicity, since counting bathrooms 
     # fractionally would give ambiguous results (i.e. 2 half baths are two separate bathrooms but counted fractionally
     # would be 1 bathroom)
+    if all(col in df for col in ZILLOW_DERIVED_COLUMNS['Bathrooms']):
+        df['bathrooms_calc']      = df['HalfBathrooms'].fillna(0).astype('int') + \
+                                    df['FullBathrooms'].fillna(0).astype('int') + \
+                                    df['ThreeQuarterBathrooms'].fillna(0).astype('int')
 
-    df['bathrooms_calc']      = df['HalfBathrooms'].fillna(0).astype('int') + \
-                                df['FullBathrooms'].fillna(0).astype('int') + \
-                                df['ThreeQuarterBathrooms'].fillna(0).astype('int')
+        if engine == 'rowwise':
+            df['bathrooms_calc'] = df['bathrooms_calc'].apply(lambda x: x if x !=0 else np.nan)
+            
+            # Fill in the final bathrooms field with either the value given in the bathrooms field
+            # or, if that is missing, the calculated field from above
+            df['Bathrooms']           = df.apply(bathroom_counter, axis=1).astype('float64')
+        else:
+            # Same logic as above, a column at a time. where() only upcasts bathrooms_calc to float when a zero was
+            # actually replaced, matching what apply() infers.
+            df['bathrooms_calc'] = df['bathrooms_calc'].where(df['bathrooms_calc'] != 0)
+
+            df['Bathrooms']           = df['Bathrooms_raw'].where(df['Bathrooms_raw'].notnull(),
+                                                              df['bathrooms_calc']).astype('float64')
 
-    df['bathrooms_calc'] = df['bathrooms_calc'].apply(lambda x: x if x !=0 else np.nan)
-    
-    # Fill in the final bathrooms field with either the value given in the bathrooms field
-    # or, if that is missing, the calculated field from above
-    df['Bathrooms']           = df.apply(bathroom_counter, axis=1)
-    
     # Truncate the description to 200 characters
-    df['Description']         = df['Full_Description'].apply(lambda x: x[0:200])
+    if all(col in df for col in ZILLOW_DERIVED_COLUMNS['Description']):
+        if engine == 'rowwise':
+            df['Description']         = df['Full_Description'].apply(lambda x: x[0:200])
+        elif len(df) > 0:
+            # infer_objects gives the sliced strings the same dtype apply() would have inferred
+            df['Description']         = df['Full_Description'].str.slice(0, 200).infer_objects()
+        else:
+            # An empty frame may not have a string column to slice at all
+            df['Description']         = df['Full_Description'].copy()
     
     return df
 
 
 
-def load_csv(df, filename, cols):
+def load_csv(df, filename, cols, append=False):
     """
     This the load stage of our ETL pipeline. It takes a DataFrame and writes a CSV.
     :param: df - the Dataframe to load
     :param: filename - the filename to write to
     :param: cols - the columns to pull from the Dataframe
+    :param: append - append the rows to an existing file, without writing the header again
     :returns: None
     :raises: None
     """
-    df.to_csv(filename, index=False, columns=cols)
+    if append:
+        df.to_csv(filename, index=False, columns=cols, mode='a', header=False)
+    else:
+        df.to_csv(filename, index=False, columns=cols)
+
+
+
+def _import_zstandard():
+    """
+    Helper function for CsvSink. zstandard is only needed for .zst output, so it is imported on first use.
+    :returns: the zstandard module
+    :raises: ImportError
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed output needs zstandard, install it with: pip install zstandard")
+    return zstandard
+
+
+
+def _compressor(compression, level):
+    """
+    Helper function for CsvSink.
+    :returns: a streaming compressor with compress and flush methods, or None for uncompressed output
+    """
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    return _import_zstandard().ZstdCompressor(level=level).compressobj()
+
+
+
+def _format_csv(df, cols, header, compression, level):
+    """
+    Helper function for CsvSink, run in its workers. Formats a chunk of rows exactly as load_csv would and
+    compresses it into a gzip member or zstd frame of its own.
+    :returns: the bytes to write
+    """
+    data = df.to_csv(index=False, columns=cols, header=header).encode('utf-8')
+    compressor = _compressor(compression, level)
+    if compressor is None:
+        return data
+    return compressor.compress(data) + compressor.flush()
+
+
+
+class CsvSink(object):
+    """
+    A load stage that writes the same CSV as load_csv, optionally gzip or zstd compressed, and formats it in
+    parallel. Every DataFrame written is cut into chunks of chunk_size rows. With several processes the chunks are
+    formatted (and compressed) in worker processes and written in order as they come back, a few chunks ahead at
+    most, so memory stays bounded however large the output is. Without, they are formatted as they are written.
+    Uncompressed output is byte for byte what to_csv(index=False, columns=cols) writes. Compressed in parallel, every
+    chunk is a gzip member or zstd frame of its own. Both formats allow them to be concatenated, and gzip, zstd and
+    Pandas read the file back as one stream. Compression is picked from the filename (.gz or .zst) unless given.
+    The file is written next to the output and only replaces it once the sink is closed.
+    """
+    COMPRESSIONS = {'gzip' : 6, 'zstd' : 3}
+
+    def __init__(self, filename, cols, compression='infer', level=None, processes=None, chunk_size=20000):
+        """
+        :param: filename - the filename to write to
+        :param: cols - the columns to pull from the Dataframes
+        :param: compression - 'gzip', 'zstd', None for plain text or 'infer' to go by the filename
+        :param: level - the compression level, defaults to 6 for gzip and 3 for zstd
+        :param: processes - format in this many worker processes. None or 1 formats in this process
+        :param: chunk_size - rows per chunk
+        :raises: ValueError, ImportError
+        """
+        if compression == 'infer':
+            compression = 'gzip' if filename.endswith('.gz') else 'zstd' if filename.endswith('.zst') else None
+        if compression is not None and compression not in self.COMPRESSIONS:
+            raise ValueError("unknown compression: " + str(compression))
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise ValueError("chunk_size must be a positive int. chunk_size: " + repr(chunk_size))
+        if compression == 'zstd':
+            _import_zstandard()
+        self.filename = filename
+        self.cols = list(cols)
+        self.compression = compression
+        self.level = self.COMPRESSIONS[compression] if compression is not None and level is None else level
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self._header = True
+        self._pending = collections.deque()
+        self._executor = None
+        self._compressor = None
+        if processes is not None and processes > 1:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+            self._ahead = 2 * processes
+        else:
+            self._compressor = _compressor(compression, self.level)
+        self._tmp = filename + '.tmp'
+        self._file = open(self._tmp, 'wb')
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(commit=exc_type is None)
+
+    def _write(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._file.write(data)
+
+    def _submit(self, df, header):
+        if self._executor is None:
+            self._write(df.to_csv(index=False, columns=self.cols, header=header).encode('utf-8'))
+            return
+        self._pending.append(self._executor.submit(_format_csv, df, self.cols, header, self.compression, self.level))
+        while len(self._pending) > self._ahead:
+            self._file.write(self._pending.popleft().result())
+
+    def write(self, df):
+        """
+        Appends the rows of a DataFrame
+        :returns: None
+        """
+        for start in range(0, len(df), self.chunk_size):
+            self._submit(df.iloc[start:start + self.chunk_size], self._header)
+            self._header = False
+        self.rows += len(df)
+
+    def close(self, commit=True):
+        """
+        Writes what is left and moves the file into place. Without commit it is thrown away instead.
+        :returns: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if commit:
+                if self._header:
+                    # Nothing was written, the file still gets its header
+                    self._submit(pd.DataFrame(columns=self.cols), True)
+                while self._pending:
+                    self._file.write(self._pending.popleft().result())
+                if self._compressor is not None:
+                    self._file.write(self._compressor.flush())
+        except BaseException:
+            commit = False
+            raise
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+            self._file.close()
+            if commit:
+                os.replace(self._tmp, self.filename)
+            else:
+                os.remove(self._tmp)
+
+
+
+def _import_pyarrow():
+    """
+    Helper function for ParquetSink. pyarrow is only needed for Parquet output, so it is imported on first use.
+    :returns: the pyarrow and pyarrow.parquet modules
+    :raises: ImportError
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output needs pyarrow, install it with: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+
+class ParquetSink(object):
+    """
+    An alternative load stage that writes Parquet instead of CSV. Every call to write appends a row group, so a feed
+    can be loaded batch by batch (see run_pipeline) without ever holding all of it in memory.
+    Columns are written with the dtype given in types, one of:
+        float64  - 64 bit floats
+        Int64    - nullable 64 bit integers
+        category - dictionary encoded strings, read back by Pandas as a category
+        string   - strings (the default for columns not in types)
+    The schema comes from types rather than from the first batch. A column that happens to be all null in one
+    batch is then still written with the same type as in every other batch.
+    With partition_cols the output is a directory of Hive style partitions (State=CA/MlsName=CLAW/part-0.parquet).
+    There is one file per partition, and the partition columns are stored in the directory names rather than in
+    the files. The output, file or directory, is built next to path and only replaces it once the sink is closed.
+    String columns are dictionary encoded within each column chunk. The files are snappy compressed.
+    """
+    def __init__(self, path, cols, partition_cols=None, types=None):
+        """
+        :param: path - the Parquet filename to write to, or the directory to write to with partition_cols
+        :param: cols - the columns to pull from the Dataframes
+        :param: partition_cols - the columns to partition the output by, or None for a single file
+        :param: types - dictionary of column name to dtype (see above)
+        :raises: ValueError, ImportError
+        """
+        self.pa, self.pq = _import_pyarrow()
+        self.path = path
+        self.partition_cols = list(partition_cols or [])
+        self.cols = [col for col in cols if col not in self.partition_cols]
+        self.types = dict(types or {})
+        for col, dtype in self.types.items():
+            if dtype is None or dtype not in ColumnBuffer.DTYPES:
+                raise ValueError("unknown dtype for column " + col + ": " + str(dtype))
+
+        arrow_types = {'float64'  : self.pa.float64(),
+                       'Int64'    : self.pa.int64(),
+                       'category' : self.pa.dictionary(self.pa.int32(), self.pa.string()),
+                       'string'   : self.pa.string()}
+        self.schema = self.pa.schema([(col, arrow_types[self.types.get(col, 'string')]) for col in self.cols])
+        self.rows = 0
+        self._writers = {}
+        self._closed = False
+        # Built next to the output, which is only replaced once the sink is closed
+        self._root = path + '.tmp'
+        if self.partition_cols:
+            shutil.rmtree(self._root, ignore_errors=True)
+            os.makedirs(self._root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(commit=exc_type is None)
+
+    def _array(self, col, series):
+        dtype = self.types.get(col, 'string')
+        if dtype == 'string':
+            # Convert values to str explicitly. A column of numbers or an all null batch (float64 in Pandas) still
+            # matches the schema
+            series = series.astype(str).where(series.notnull(), None).astype(object)
+        elif dtype == 'category' and not isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype('category')
+        elif dtype != 'category':
+            series = series.astype(dtype)
+        return self.pa.array(series, type=self.schema.field(col).type, from_pandas=True)
+
+    def _writer(self, key):
+        writer = self._writers.get(key)
+        if writer is None:
+            if self.partition_cols:
+                segments = [col + '=' + ('__HIVE_DEFAULT_PARTITION__' if pd.isnull(value) else
+                                         urllib.parse.quote(str(value), safe=''))
+                            for col, value in zip(self.partition_cols, key)]
+                directory = os.path.join(self._root, *segments)
+                os.makedirs(directory, exist_ok=True)
+                filename = os.path.join(directory, 'part-0.parquet')
+            else:
+                filename = self._root
+            strings = [col for col in self.cols if self.types.get(col, 'string') in ('string', 'category')]
+            writer = self.pq.ParquetWriter(filename, self.schema, use_dictionary=strings, compression='snappy')
+            self._writers[key] = writer
+        return writer
+
+    def write(self, df):
+        """
+        Appends a DataFrame to the output as a row group (one per partition with partition_cols).
+        :param: df - the DataFrame to load
+        :returns: None
+        :raises: ValueError, KeyError
+        """
+        if self.partition_cols:
+            groups = df.groupby(self.partition_cols, dropna=False, observed=True, sort=False)
+            parts = [(key if isinstance(key, tuple) else (key,), group) for key, group in groups]
+        else:
+            parts = [((), df)]
+        for key, part in parts:
+            table = self.pa.Table.from_arrays([self._array(col, part[col]) for col in self.cols], schema=self.schema)
+            self._writer(key).write_table(table)
+        self.rows += len(df)
+
+    def close(self, commit=True):
+        """
+        Finishes every file, then replaces whatever was at path with the output. With commit=False the output is
+        thrown away instead, and path is left as it was.
+        :returns: None
+        :raises: IOError
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if commit and not self.partition_cols and not self._writers:
+            # An empty single file output still gets the schema
+            self._writer(())
+        for writer in self._writers.values():
+            writer.close()
+        if not commit:
+            if os.path.isdir(self._root):
+                shutil.rmtree(self._root, ignore_errors=True)
+            elif os.path.exists(self._root):
+                os.remove(self._root)
+            return
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        elif os.path.exists(self.path) and self.partition_cols:
+            os.remove(self.path)
+        os.replace(self._root, self.path)
+
+
+
+def load_parquet(df, path, cols, partition_cols=None, types=None):
+    """
+    Loads a DataFrame into Parquet in one go. See ParquetSink for the parameters.
+    :returns: None
+    :raises: ValueError, ImportError
+    """
+    with ParquetSink(path, cols, partition_cols=partition_cols, types=types) as sink:
+        sink.write(df)
+
+
+
+def _quote(name):
+    """
+    Helper function for SqliteSink. Quotes an identifier for SQLite.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+
+class SqliteSink(object):
+    """
+    A load stage that upserts listings into a SQLite table instead of writing a CSV. The table is created from the
+    output columns if it doesn't exist yet, with a primary key on the key columns. Listings whose key is already in
+    the table replace the stored row, so loading a feed again leaves one row per listing. Key columns are NOT NULL,
+    a missing key value is stored as '' (as run_incremental keys listings), so SQLite's NULLs, which never conflict,
+    can't let a listing in twice.
+    Columns are typed the same way as in ParquetSink: float64 columns are stored as REAL, Int64 columns as INTEGER
+    and the rest as TEXT.
+    Every call to write inserts the DataFrame chunk_size rows at a time with executemany, so only one chunk of
+    Python values exists at once. The whole load runs in a single transaction, committed when the sink is closed,
+    so a failed load leaves the table as it was. Secondary indexes are dropped before the load and built once
+    it is over, which is much cheaper than keeping them up to date row by row.
+    """
+    SQL_TYPES = {'float64' : 'REAL', 'Int64' : 'INTEGER', 'category' : 'TEXT', 'string' : 'TEXT'}
+
+    def __init__(self, filename, cols, table='listings', key=('MlsId', 'MlsName'), types=None, indexes=None,
+                 chunk_size=50000):
+        """
+        :param: filename - the SQLite database to load into. It is created if it doesn't exist
+        :param: cols - the columns to pull from the Dataframes
+        :param: table - the table to load into
+        :param: key - the columns identifying a listing
+        :param: types - dictionary of column name to dtype (see ParquetSink)
+        :param: indexes - columns to build secondary indexes on once the load is over, i.e. Price, Zip, DateListed
+        :param: chunk_size - number of rows handed to each executemany call
+        :raises: ValueError, sqlite3.Error
+        """
+        self.cols = list(cols)
+        self.table = table
+        self.key = list(key)
+        self.types = dict(types or {})
+        self.indexes = list(indexes or [])
+        self.chunk_size = chunk_size
+        for col in self.key + self.indexes:
+            if col not in self.cols:
+                raise ValueError("key and index columns must be output columns. col name: " + col)
+        for col, dtype in self.types.items():
+            if dtype not in self.SQL_TYPES:
+                raise ValueError("unknown dtype for column " + col + ": " + str(dtype))
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1. chunk_size: " + str(chunk_size))
+        self.rows = 0
+        self._closed = False
+
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        try:
+            self.db.execute("PRAGMA cache_size = -65536")
+            self.db.execute("BEGIN")
+            self.db.execute("CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s))" % (
+                _quote(table),
+                ", ".join(_quote(col) + " " + self.SQL_TYPES[self.types.get(col, 'string')]
+                          + (" NOT NULL" if col in self.key else "") for col in self.cols),
+                ", ".join(_quote(col) for col in self.key)))
+            for col in self.indexes:
+                self.db.execute("DROP INDEX IF EXISTS " + self._index_name(col))
+        except Exception:
+            self.db.close()
+            raise
+
+        names = ", ".join(_quote(col) for col in self.cols)
+        updates = ", ".join(_quote(col) + " = excluded." + _quote(col) for col in self.cols if col not in self.key)
+        self._upsert = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO %s" % (
+            _quote(table), names, ", ".join("?" * len(self.cols)), ", ".join(_quote(col) for col in self.key),
+            "UPDATE SET " + updates if updates else "NOTHING")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(commit=exc_type is None)
+
+    def _index_name(self, col):
+        return _quote(self.table + "_" + col)
+
+    def _values(self, col, series):
+        """
+        Converts a column into a list of Python values for sqlite3, with None for nulls ('' in key columns)
+        """
+        dtype = self.types.get(col, 'string')
+        if dtype in ('float64', 'Int64'):
+            series = series.astype(dtype)
+        elif series.dtype.kind in 'biuf':
+            # Numbers in a TEXT column are rendered the same way load_csv renders them
+            series = series.astype(str).where(series.notnull())
+        return series.to_numpy(dtype=object, na_value='' if col in self.key else None).tolist()
+
+    def write(self, df):
+        """
+        Upserts the rows of a DataFrame.
+        :param: df - the DataFrame to load
+        :returns: None
+        :raises: ValueError, KeyError, sqlite3.Error
+        """
+        for start in range(0, len(df), self.chunk_size):
+            chunk = df.iloc[start:start + self.chunk_size]
+            self.db.executemany(self._upsert, zip(*[self._values(col, chunk[col]) for col in self.cols]))
+        self.rows += len(df)
+
+    def close(self, commit=True):
+        """
+        Builds the indexes and commits the load. With commit=False the load is rolled back instead.
+        :returns: None
+        :raises: sqlite3.Error
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if commit:
+                for col in self.indexes:
+                    self.db.execute("CREATE INDEX %s ON %s (%s)" % (self._index_name(col), _quote(self.table),
+                                                                   _quote(col)))
+                self.db.execute("COMMIT")
+            else:
+                self.db.execute("ROLLBACK")
+        finally:
+            self.db.close()
+
+
+
+def load_sqlite(df, filename, cols, table='listings', key=('MlsId', 'MlsName'), types=None, indexes=None):
+    """
+    Upserts a DataFrame into a SQLite table in one go. See SqliteSink for the parameters.
+    :returns: None
+    :raises: ValueError, sqlite3.Error
+    """
+    with SqliteSink(filename, cols, table=table, key=key, types=types, indexes=indexes) as sink:
+        sink.write(df)
+
+
+
+class Metrics(object):
+    """
+    Opt-in instrumentation for a run (see run_pipeline). It records:
+        - the wall time and rows of every stage (extract, transform and load)
+        - the time spent on each column of the spec while extracting: evaluating its XPath, or turning what the
+          shared walk of the simple columns found for it into a value (see ColumnExtractor), then checking,
+          truncating and buffering its values. The walk itself visits every listing once for all the simple
+          columns, and is timed once and reported with the columns it covers. With isolate_columns every column
+          is evaluated with its own XPath instead, so its whole cost shows up under its name. Extracting is slower
+          that way, so it is only worth it to find out which columns cost the time.
+        - the peak resident set size of the process and the bytes read from the feed
+    Nothing is measured unless a Metrics object is passed in, so a run without one pays nothing for it.
+    Hooks are callables called as hook(event, stage, metrics), with event 'start' or 'end' around every timed step
+    of a stage and 'finish' (stage None) once the run is over. They can switch a profiler on and off around a stage,
+    or export the numbers to a metrics system.
+    """
+    STAGES = ('extract', 'transform', 'load')
+
+    def __init__(self, hooks=None, isolate_columns=False):
+        """
+        :param hooks: list of hook callables (see above)
+        :param isolate_columns: evaluate every column with its own XPath while extracting (see above)
+        """
+        self.hooks = list(hooks or [])
+        self.isolate_columns = isolate_columns
+        self.stages = dict((stage, {'seconds' : 0.0, 'rows' : 0}) for stage in self.STAGES)
+        self.bytes_read = None
+        self._column_timings = []
+
+    def _notify(self, event, stage):
+        for hook in self.hooks:
+            hook(event, stage, self)
+
+    def measure(self, stage, rows, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs), adding its wall time and rows to the stage
+        :returns: whatever func returns
+        """
+        self._notify('start', stage)
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.stages[stage]['seconds'] += time.perf_counter() - start
+        self.stages[stage]['rows'] += rows
+        self._notify('end', stage)
+        return result
+
+    def measure_batches(self, stage, batches):
+        """
+        Wraps a generator of DataFrames, adding the time spent producing every batch and its rows to the stage
+        :returns: a generator of the same DataFrames
+        """
+        batches = iter(batches)
+        while True:
+            self._notify('start', stage)
+            start = time.perf_counter()
+            batch = next(batches, None)
+            self.stages[stage]['seconds'] += time.perf_counter() - start
+            if batch is not None:
+                self.stages[stage]['rows'] += len(batch)
+            self._notify('end', stage)
+            if batch is None:
+                return
+            yield batch
+
+    def column_timings(self, extractor):
+        """
+        :param extractor: a ColumnExtractor
+        :returns: the extractor to extract with, isolated with isolate_columns, and a list for it to add its column
+                  timings to (see ColumnExtractor.__call__). The list is folded into the report
+        """
+        if self.isolate_columns and not extractor.isolate:
+            extractor = ColumnExtractor(extractor.columns, isolate=True)
+        timings = [0.0] * (len(extractor.columns) + 1)
+        self._column_timings.append((extractor, timings))
+        return extractor, timings
+
+    def finish(self):
+        """
+        Tells the hooks the run is over
+        """
+        self._notify('finish', None)
+
+    @staticmethod
+    def peak_rss():
+        """
+        :returns: the peak resident set size of this process in bytes, None where the platform can't tell
+        """
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def report(self):
+        """
+        :returns: the metrics as a JSON serializable dictionary
+        """
+        stages = {}
+        for stage, totals in self.stages.items():
+            seconds = totals['seconds']
+            stages[stage] = {'seconds'         : round(seconds, 6),
+                             'rows'            : totals['rows'],
+                             'rows_per_second' : round(totals['rows'] / seconds, 1) if seconds > 0 else None}
+        columns, walk, walked = {}, 0.0, []
+        for extractor, timings in self._column_timings:
+            for i, name in enumerate(extractor.names):
+                columns[name] = columns.get(name, 0.0) + timings[i]
+            walk += timings[-1]
+            walked.extend(extractor.names[i] for i, func in extractor._simple if extractor.names[i] not in walked)
+        return {'stages'         : stages,
+                'columns'        : dict((name, round(seconds, 6)) for name, seconds in columns.items()),
+                'column_walk'    : {'seconds' : round(walk, 6), 'columns' : walked},
+                'peak_rss_bytes' : self.peak_rss(),
+                'bytes_read'     : self.bytes_read}
+
+    def to_json(self):
+        """
+        :returns: the report as a JSON document
+        """
+        return json.dumps(self.report(), indent=2)
+
+    def log_line(self):
+        """
+        :returns: the report as a single line, i.e. for a log
+        """
+        report = self.report()
+        parts = []
+        for stage in self.STAGES:
+            totals = report['stages'][stage]
+            parts.append("%s %.3fs %d rows (%.0f rows/s)" % (stage, totals['seconds'], totals['rows'],
+                                                              totals['rows_per_second'] or 0))
+        if report['peak_rss_bytes'] is not None:
+            parts.append("peak rss %.1fMB" % (report['peak_rss_bytes'] / 1e6))
+        if report['bytes_read'] is not None:
+            parts.append("read %.1fMB" % (report['bytes_read'] / 1e6))
+        return ", ".join(parts)
+
+
+
+def _measure(metrics, stage, rows, func, *args, **kwargs):
+    """
+    Helper function for run_pipeline. Calls func through metrics.measure when there are metrics.
+    """
+    if metrics is None:
+        return func(*args, **kwargs)
+    return metrics.measure(stage, rows, func, *args, **kwargs)
+
+
+
+def run_pipeline(source, columns, path_to_listings, output, output_columns, batch_size=None, stream=False,
+                 engine='vectorized', processes=None, cache_dir=None, partition_cols=None, output_types=None,
+                 indexes=None, extract_cache=None, metrics=None):
+    """
+    Runs extract -> transform -> load for a single feed. Only the columns of the spec that the output needs are
+    extracted (see project_columns).
+    When a batch_size is given the feed is streamed (see iter_extract_xml) and every batch is transformed and
+    appended to the output as soon as it has been extracted, so peak memory depends on the batch size rather than on
+    the size of the feed. The CSV written is identical to the one written in a single pass. Batches are written
+    through CsvSink, next to the output, so a feed that fails halfway leaves the previous output in place.
+    An output ending in .parquet, or any output with partition_cols, is written as Parquet instead (see ParquetSink),
+    one row group per batch. An output ending in .db, .sqlite or .sqlite3 is upserted into its listings table
+    (see SqliteSink). A CSV output ending in .gz or .zst is compressed, and is written through CsvSink along with
+    any CSV written with several processes.
+    :param: source - url or filename of the XML feed
+    :param: columns - column spec (see extract_xml for details)
+    :param: path_to_listings - the XPath to the listing records (see extract_xml for details)
+    :param: output - the CSV, Parquet or SQLite filename, or the Parquet directory with partition_cols, to write to
+    :param: output_columns - the columns to write
+    :param: batch_size - number of listings per batch, or None to process the whole feed at once
+    :param: stream - stream the feed when processing it at once (see extract_xml)
+    :param: engine - the transform engine (see transform)
+    :param: processes - parse a local feed in this many processes when processing it at once (see
+                        extract_xml_parallel), and format CSV output in this many processes (see CsvSink)
+    :param: cache_dir - fetch a remote feed through open_feed, caching it in this directory. When the feed hasn't
+                        changed since the output was written, nothing is extracted
+    :param: partition_cols - write a Parquet directory partitioned by these columns
+    :param: output_types - the dtype of each Parquet or SQLite column (see ParquetSink). Ignored for CSV
+    :param: indexes - columns to index once a SQLite load is over (see SqliteSink). Ignored otherwise
+    :param: extract_cache - an ExtractCache, or the directory of one, to extract a local feed processed at once
+                            through. Ignored for remote feeds and batches
+    :param: metrics - optional Metrics to record the run in. Columns aren't timed when a feed is parsed in
+                      several processes
+    :returns: the number of listings written, None if the feed hadn't changed
+    :raises: TypeError, ValueError, IOError, ImportError, sqlite3.Error, lxml.etree.XMLSyntaxError
+    """
+    if cache_dir is not None and re.match(r'^https?://', source):
+        feed = open_feed(source, cache_dir, output=output)
+        if feed is None:
+            if metrics is not None:
+                metrics.finish()
+            return None
+        with feed:
+            rows = run_pipeline(feed, columns, path_to_listings, output, output_columns, batch_size=batch_size,
+                                stream=stream, engine=engine, partition_cols=partition_cols,
+                                output_types=output_types, indexes=indexes, metrics=metrics)
+        # Only once the output has been written, so a failed load is retried on the next run
+        feed.commit()
+        return rows
+
+    if isinstance(extract_cache, str):
+        extract_cache = ExtractCache(extract_cache)
+    cacheable = extract_cache is not None and batch_size is None and isinstance(source, str) and \
+        os.path.isfile(source)
+
+    # Only extract the columns the output needs, directly or through transform
+    columns = project_columns(columns, list(output_columns) + list(partition_cols or []), ZILLOW_DERIVED_COLUMNS)
+
+    # A generator, rather than a list, so a feed processed at once isn't kept alive while it's being loaded
+    if cacheable:
+        batches = (extract_cache.extract(source, columns, path_to_listings, stream=stream, processes=processes)
+                   for _ in range(1))
+    elif batch_size is None and processes is not None and processes > 1:
+        batches = (extract_xml_parallel(source, columns, path_to_listings, processes=processes) for _ in range(1))
+    elif batch_size is None:
+        batches = (extract_xml(source, columns, path_to_listings, stream=stream, metrics=metrics) for _ in range(1))
+    else:
+        batches = iter_extract_xml(source, columns, path_to_listings, batch_size, metrics=metrics)
+    if metrics is not None:
+        batches = metrics.measure_batches('extract', batches)
+
+    if partition_cols or output.endswith('.parquet'):
+        sink = ParquetSink(output, output_columns, partition_cols=partition_cols, types=output_types)
+    elif output.endswith(('.db', '.sqlite', '.sqlite3')):
+        sink = SqliteSink(output, output_columns, types=output_types, indexes=indexes)
+    elif output.endswith(('.gz', '.zst')) or batch_size is not None or (processes is not None and processes > 1):
+        sink = CsvSink(output, output_columns, processes=processes)
+    else:
+        sink = None
+
+    rows = 0
+    if sink is not None:
+        try:
+            for batch in batches:
+                df = _measure(metrics, 'transform', len(batch), transform, batch, engine=engine)
+                _measure(metrics, 'load', len(df), sink.write, df)
+                rows += len(df)
+        except BaseException:
+            sink.close(commit=False)
+            raise
+        # Closing commits the load (and builds any indexes), so it counts as loading
+        _measure(metrics, 'load', 0, sink.close)
+    else:
+        for batch in batches:
+            df = _measure(metrics, 'transform', len(batch), transform, batch, engine=engine)
+            _measure(metrics, 'load', len(df), load_csv, df, output, output_columns)
+            rows += len(df)
+
+    if metrics is not None:
+        if hasattr(source, 'bytes_read'):
+            metrics.bytes_read = source.bytes_read
+        elif isinstance(source, str) and os.path.isfile(source):
+            metrics.bytes_read = os.path.getsize(source)
+        metrics.finish()
+    return rows
+
+
+
+def _listing_hashes(df):
+    """
+    Helper function for run_incremental. Hashes the extracted values of every listing. Columns are compared as
+    strings so a listing hashes the same no matter which dtype Pandas inferred for the batch it was read in.
+    :returns: a NumPy array of signed 64 bit hashes (SQLite can't store unsigned ones)
+    """
+    canonical = pd.DataFrame({i : df[col].astype(object).where(df[col].notnull(), '\x00').astype(str)
+                              for i, col in enumerate(df.columns)})
+    return pd.util.hash_pandas_object(canonical, index=False).values.view(np.int64)
+
+
+
+def _csv_records(text):
+    """
+    Helper function for run_incremental. Splits the output of to_csv into one string per record. A record ends at
+    a newline once its quotes are balanced, since quoted fields may hold newlines of their own.
+    """
+    records, current, quotes = [], [], 0
+    for line in text.split('\n')[:-1]:
+        current.append(line)
+        quotes += line.count('"')
+        if quotes % 2 == 0:
+            records.append('\n'.join(current) + '\n')
+            current, quotes = [], 0
+    return records
+
+
+
+def run_incremental(source, columns, path_to_listings, output, output_columns, state, key=('MlsId', 'MlsName'),
+                    batch_size=10000, engine='vectorized'):
+    """
+    Runs extract -> transform -> load incrementally. A SQLite state store keeps a hash of every listing's extracted
+    values and its rendered CSV record, keyed on the key columns. On each run the feed is streamed in batches and
+    only new or changed listings are transformed and formatted. Listings missing from the feed are deleted.
+    The output is then brought up to date without transforming anything else:
+        - it is left alone when nothing changed
+        - new listings are appended when nothing else changed
+        - otherwise it is rewritten from the stored records
+    The output is the same as run_pipeline would write as long as the key is unique within the feed. When it isn't,
+    the last listing with the key wins: the others are dropped before anything is compared, so a repeated key is
+    counted once and an unchanged feed stays unchanged from one run to the next.
+    :param: source - url or filename of the XML feed
+    :param: columns - column spec (see extract_xml for details)
+    :param: path_to_listings - the XPath to the listing records (see extract_xml for details)
+    :param: output - the CSV filename to keep up to date
+    :param: output_columns - the columns to write
+    :param: state - the SQLite filename of the state store. It is created if it doesn't exist
+    :param: key - the columns identifying a listing. The MLS id alone isn't unique across boards
+    :param: batch_size - number of listings per batch (see iter_extract_xml)
+    :param: engine - the transform engine (see transform)
+    :returns: a dictionary counting the new, changed, unchanged and deleted listings, and saying what happened to
+              the output ('unchanged', 'appended' or 'rewritten')
+    :raises: TypeError, ValueError, lxml.etree.XMLSyntaxError
+    """
+    key = list(key)
+    extractor = compile_columns(project_columns(columns, list(output_columns) + key, ZILLOW_DERIVED_COLUMNS))
+    # Listings hashed or rendered with a different spec can't be compared, so the state is reset when it changes
+    fingerprint = hashlib.sha1(json.dumps([extractor.columns, list(output_columns), key],
+                                          sort_keys=True).encode()).hexdigest()
+    summary = {'new' : 0, 'changed' : 0, 'unchanged' : 0, 'deleted' : 0}
+
+    db = sqlite3.connect(state)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS listings (key TEXT PRIMARY KEY, hash INTEGER, position INTEGER, "
+                   "record TEXT, run INTEGER)")
+        db.execute("CREATE TEMP TABLE batch (key TEXT PRIMARY KEY, position INTEGER)")
+        # The hash and position every key of this run had after the last run, and what this run made of it
+        db.execute("CREATE TEMP TABLE seen (key TEXT PRIMARY KEY, hash INTEGER, position INTEGER, status TEXT)")
+        meta = dict(db.execute("SELECT name, value FROM meta"))
+        reset = meta.get('fingerprint') != fingerprint
+        if reset:
+            db.execute("DELETE FROM listings")
+        run = 1 if reset else int(meta['run']) + 1
+
+        position = 0
+        for batch in iter_extract_xml(source, extractor, path_to_listings, batch_size):
+            parts = [batch[col].astype(object).where(batch[col].notnull(), '').astype(str) for col in key]
+            keys = parts[0]
+            for part in parts[1:]:
+                keys = keys + '\x1f' + part
+            keys = keys.tolist()
+            hashes = _listing_hashes(batch).tolist()
+            positions = list(range(position, position + len(batch)))
+            position += len(batch)
+            # When a key repeats within the batch the last listing with it wins
+            last = dict((k, i) for i, k in enumerate(keys))
+            rows = [i for i, k in enumerate(keys) if last[k] == i]
+
+            db.execute("DELETE FROM batch")
+            db.executemany("INSERT INTO batch VALUES (?, ?)", ((keys[i], positions[i]) for i in rows))
+            # Only the first time the run meets a key does the store still hold the last run's listing
+            db.execute("INSERT OR IGNORE INTO seen SELECT b.key, l.hash, l.position, NULL FROM batch b "
+                       "LEFT JOIN listings l ON l.key = b.key")
+            previous = dict((k, (h, status)) for k, h, status in db.execute(
+                "SELECT s.key, s.hash, s.status FROM batch b JOIN seen s ON s.key = b.key"))
+
+            stale = []
+            statuses = []
+            for i in rows:
+                prior, counted = previous[keys[i]]
+                if counted is not None:
+                    # A listing earlier in this run had the key. This one replaces it, and is compared with the
+                    # last run in its place
+                    summary[counted] -= 1
+                if prior is None:
+                    status = 'new'
+                elif prior != hashes[i]:
+                    status = 'changed'
+                else:
+                    status = 'unchanged'
+                summary[status] += 1
+                statuses.append((status, keys[i]))
+                # The stored record may be the replaced listing's, so a repeated key is always formatted again
+                if status != 'unchanged' or counted is not None:
+                    stale.append(i)
+            db.executemany("UPDATE seen SET status = ? WHERE key = ?", statuses)
+
+            # Unchanged listings only need to be marked as seen
+            db.execute("UPDATE listings SET run = ?, position = (SELECT b.position FROM batch b WHERE "
+                       "b.key = listings.key) WHERE key IN (SELECT key FROM batch)", (run,))
+            if stale:
+                changed = transform(batch.iloc[stale].reset_index(drop=True), engine=engine)
+                records = _csv_records(changed.to_csv(index=False, header=False, columns=output_columns))
+                db.executemany("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                               ((keys[i], hashes[i], positions[i], record, run) for i, record in zip(stale, records)))
+
+        summary['deleted'] = db.execute("DELETE FROM listings WHERE run != ?", (run,)).rowcount
+        moved = db.execute("SELECT COUNT(*) FROM seen s JOIN listings l ON l.key = s.key "
+                           "WHERE s.status = 'unchanged' AND l.position != s.position").fetchone()[0] > 0
+
+        # Bring the output up to date. If it isn't the file the last run left behind (i.e. that run died before
+        # saving its state) it can't be patched.
+        intact = os.path.exists(output) and str(os.path.getsize(output)) == meta.get('output_size')
+        if reset or moved or summary['changed'] or summary['deleted'] or not intact:
+            with open(output + '.tmp', 'w', newline='') as f:
+                f.write(pd.DataFrame(columns=output_columns).to_csv(index=False))
+                for (record,) in db.execute("SELECT record FROM listings ORDER BY position"):
+                    f.write(record)
+            os.replace(output + '.tmp', output)
+            summary['output'] = 'rewritten'
+        elif summary['new']:
+            # Nothing moved, so every new listing comes after the ones already in the output
+            with open(output, 'a', newline='') as f:
+                for (record,) in db.execute("SELECT l.record FROM listings l JOIN seen s ON s.key = l.key "
+                                            "WHERE s.status = 'new' ORDER BY l.position"):
+                    f.write(record)
+            summary['output'] = 'appended'
+        else:
+            summary['output'] = 'unchanged'
+
+        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [('fingerprint', fingerprint), ('run', str(run)),
+                                                                   ('output_size', str(os.path.getsize(output)))])
+        db.commit()
+    finally:
+        db.close()
+    return summary
+
+
+
+def available_cpus():
+    """
+    :returns: the number of cores this process may run on
+    :raises: None
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+
+def load_manifest(filename):
+    """
+    Reads a manifest of jobs for run_jobs. The manifest is a JSON array of objects with the following fields:
+        source           - url or filename of the XML feed (required)
+        output           - the CSV filename to write to (required)
+        columns          - the column spec, either inline or the filename of a JSON file holding it. Defaults to
+                           the Zillow spec
+        path_to_listings - the XPath to the listing records. Defaults to the Zillow path
+        output_columns   - the columns to write. Defaults to the Zillow output columns
+        batch_size       - see run_pipeline. Defaults to processing the feed at once
+        cache_dir        - see run_pipeline. Defaults to fetching remote feeds without a cache
+        partition_cols   - see run_pipeline. Defaults to a single output file
+        output_types     - see run_pipeline. Defaults to the Zillow output types
+        indexes          - see run_pipeline. Defaults to no indexes
+        extract_cache    - the directory of an ExtractCache, see run_pipeline. Defaults to extracting every time
+    :param filename: the manifest filename
+    :returns: a list of job dictionaries with the defaults filled in
+    :raises: ValueError, IOError
+    """
+    with open(filename) as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list):
+        raise ValueError("manifest must be a JSON array of jobs. manifest: " + filename)
+    return [parse_job(entry, os.path.dirname(filename)) for entry in manifest]
+
+
+
+def parse_job(entry, directory=''):
+    """
+    Fills in the defaults of a single job (see load_manifest for the fields)
+    :param entry: the job as read from JSON
+    :param directory: the directory a column spec filename is relative to
+    :returns: the job dictionary
+    :raises: ValueError, IOError
+    """
+    if not isinstance(entry, dict) or 'source' not in entry or 'output' not in entry:
+        raise ValueError("every job needs a source and an output. job: " + json.dumps(entry))
+    job = {'source'           : entry['source'],
+           'output'           : entry['output'],
+           'columns'          : entry.get('columns', ZILLOW_COLUMNS),
+           'path_to_listings' : entry.get('path_to_listings', ZILLOW_PATH_TO_LISTINGS),
+           'output_columns'   : entry.get('output_columns', ZILLOW_OUTPUT_COLUMNS),
+           'batch_size'       : entry.get('batch_size'),
+           'cache_dir'        : entry.get('cache_dir'),
+           'partition_cols'   : entry.get('partition_cols'),
+           'output_types'     : entry.get('output_types', ZILLOW_OUTPUT_TYPES),
+           'indexes'          : entry.get('indexes'),
+           'extract_cache'    : entry.get('extract_cache')}
+    # A column spec may live in its own file, relative to the manifest
+    if isinstance(job['columns'], str):
+        with open(os.path.join(directory, job['columns'])) as f:
+            job['columns'] = json.load(f)
+    return job
+
+
+
+def run_job(job):
+    """
+    Runs a single job from a manifest (see load_manifest). Errors are caught and reported in the result so that one
+    bad feed doesn't stop the rest of the batch.
+    :param job: the job dictionary
+    :returns: a dictionary with the source, output, status ('ok', 'unchanged' or 'failed'), rows written, seconds
+              taken and error
+    :raises: None
+    """
+    start = time.time()
+    result = {'source' : job['source'], 'output' : job['output'], 'status' : 'ok', 'rows' : 0, 'error' : None}
+    try:
+        rows = run_pipeline(job['source'], job['columns'], job['path_to_listings'], job['output'],
+                            job['output_columns'], batch_size=job.get('batch_size'), cache_dir=job.get('cache_dir'),
+                            partition_cols=job.get('partition_cols'), output_types=job.get('output_types'),
+                            indexes=job.get('indexes'), extract_cache=job.get('extract_cache'))
+        if rows is None:
+            result['status'] = 'unchanged'
+        else:
+            result['rows'] = rows
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = type(e).__name__ + ": " + str(e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+
+# Set in the worker processes of run_jobs, they put the index of every job they start on it
+_started_jobs = None
+
+
+def _init_job_worker(started):
+    """
+    Initializer of the worker processes of run_jobs
+    """
+    global _started_jobs
+    _started_jobs = started
+
+
+def _run_job_at(i, job):
+    """
+    Runs the job at index i of run_jobs in a worker process, after telling the parent that it started
+    """
+    _started_jobs.put(i)
+    return run_job(job)
+
+
+def run_jobs(jobs, processes=None):
+    """
+    Runs many jobs across a pool of worker processes. Each worker imports pandas and lxml once and then handles as
+    many jobs as it is given, instead of paying for a new interpreter per feed.
+    A worker that dies (i.e. it was killed or ran out of memory) breaks the whole pool. The jobs that had not started
+    yet are run in a new pool, and the ones that were running are run again one at a time, each in a pool of its own,
+    so only the job that kills its worker fails.
+    :param jobs: list of job dictionaries (see load_manifest)
+    :param processes: the number of worker processes. Defaults to the number of available cores
+    :returns: a list of results (see run_job) in the same order as the jobs
+    :raises: None
+    """
+    processes = min(processes or available_cpus(), max(len(jobs), 1))
+    results = [None] * len(jobs)
+    waiting, suspects = list(range(len(jobs))), []
+    while waiting or suspects:
+        alone = not waiting
+        batch = [suspects.pop(0)] if alone else waiting
+        started = multiprocessing.SimpleQueue()
+        broken = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1 if alone else processes,
+                                                    initializer=_init_job_worker, initargs=(started,)) as executor:
+            futures = [executor.submit(_run_job_at, i, jobs[i]) for i in batch]
+            for i, future in zip(batch, futures):
+                try:
+                    results[i] = future.result()
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    broken[i] = e
+                except Exception as e:
+                    results[i] = {'source' : jobs[i]['source'], 'output' : jobs[i]['output'], 'status' : 'failed',
+                                  'rows' : 0, 'seconds' : 0.0, 'error' : type(e).__name__ + ": " + str(e)}
+        ran = set()
+        while not started.empty():
+            ran.add(started.get())
+        started.close()
+        if alone:
+            for i, e in broken.items():
+                results[i] = {'source' : jobs[i]['source'], 'output' : jobs[i]['output'], 'status' : 'failed',
+                              'rows' : 0, 'seconds' : 0.0, 'error' : type(e).__name__ + ": " + str(e)}
+        else:
+            waiting = [i for i in broken if i not in ran]
+            suspects.extend(i for i in broken if i in ran)
+    return results
+
+
+
+def format_result(result):
+    """
+    :param result: a result from run_job
+    :returns: a single line report for the result
+    :raises: None
+    """
+    line = "%-6s %8.2fs %8d rows  %s -> %s" % (result['status'], result['seconds'], result['rows'],
+                                               result['source'], result['output'])
+    return line if result['error'] is None else line + "  " + result['error']
+
+
+
+class Worker(object):
+    """
+    A long running process that picks jobs up from a directory, so pandas, numpy and lxml are imported once and
+    every job only costs its own processing time. Compiled column specs, extract caches (see ExtractCache) and the
+    connections to feed servers are kept from one job to the next.
+    Every file ending in .json in the directory is a job, or a JSON array of jobs, with the fields of a manifest
+    entry (see load_manifest). Files starting with a . are ignored, so a job can be written under a hidden name and
+    renamed into place once it is complete. A file is claimed by renaming it to .running, which lets several workers
+    share a directory. Once its jobs have run it is moved to done/, or to failed/ if any of them failed, next to a
+    .result file holding their results (see run_job).
+    The latency of every job is counted in a histogram, written with the job counts to .status.json in the directory
+    after every file.
+    stop() (SIGTERM or SIGINT while run() is running) shuts the worker down gracefully: the job being run is
+    finished, and any jobs left in its file are put back in the directory for the next worker.
+    """
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, directory, interval=0.5, defaults=None):
+        """
+        :param directory: the directory to watch
+        :param interval: seconds to wait between looks at an empty directory
+        :param defaults: dictionary of job fields used by jobs that leave them out, i.e. extract_cache or cache_dir
+        """
+        self.directory = directory
+        self.interval = interval
+        self.defaults = dict(defaults or {})
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.jobs = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.started = time.time()
+        self._stopping = False
+        self._specs = {}
+        self._extract_caches = {}
+        for name in ('done', 'failed'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Asks the worker to stop once the job being run is over. Also the SIGTERM and SIGINT handler.
+        """
+        self._stopping = True
+
+    def observe(self, seconds):
+        """
+        Counts a job latency in the histogram
+        """
+        i = 0
+        while i < len(self.BUCKETS) and seconds > self.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.seconds += seconds
+
+    def histogram(self):
+        """
+        :returns: the job latencies as a list of (upper bound in seconds, jobs), each count including the jobs of
+                  the buckets below it. The last bound is None, for every job
+        """
+        return list(zip(self.BUCKETS + (None,), itertools.accumulate(self.counts)))
+
+    def status(self):
+        """
+        :returns: a dictionary of jobs run and failed, seconds spent on them, uptime and the latency histogram
+        """
+        return {'jobs'      : self.jobs,
+                'failed'    : self.failed,
+                'seconds'   : self.seconds,
+                'uptime'    : time.time() - self.started,
+                'histogram' : self.histogram()}
+
+    def prepare(self, job):
+        """
+        Swaps a job's column spec for a compiled one, reused by every job with the same spec and output, and its
+        extract cache directory for a warm ExtractCache
+        :returns: the job, ready for run_job
+        """
+        job = dict(job)
+        for field, value in self.defaults.items():
+            if job.get(field) is None:
+                job[field] = value
+        needed = list(job['output_columns']) + list(job.get('partition_cols') or [])
+        key = json.dumps([job['columns'], needed], sort_keys=True)
+        extractor = self._specs.get(key)
+        if extractor is None:
+            extractor = compile_columns(project_columns(job['columns'], needed, ZILLOW_DERIVED_COLUMNS))
+            self._specs[key] = extractor
+        job['columns'] = extractor
+        if isinstance(job.get('extract_cache'), str):
+            directory = job['extract_cache']
+            if directory not in self._extract_caches:
+                self._extract_caches[directory] = ExtractCache(directory)
+            job['extract_cache'] = self._extract_caches[directory]
+        return job
+
+    @staticmethod
+    def _failure(job, e):
+        return {'source' : job['source'], 'output' : job['output'], 'status' : 'failed', 'rows' : 0,
+                'seconds' : 0.0, 'error' : type(e).__name__ + ": " + str(e)}
+
+    def _record(self, result):
+        self.observe(result['seconds'])
+        self.jobs += 1
+        self.failed += result['status'] == 'failed'
+        return result
+
+    def _write(self, path, document):
+        tmp = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(document, f, indent=2)
+            f.write("\n")
+        os.replace(tmp, path)
+
+    def run_file(self, path):
+        """
+        Claims a job file and runs its jobs
+        :returns: the list of results, None if another worker claimed the file first
+        """
+        running = path + '.running'
+        try:
+            os.rename(path, running)
+        except OSError:
+            return None
+        name = os.path.basename(path)
+        results = []
+        try:
+            with open(running) as f:
+                entries = json.load(f)
+            entries = entries if isinstance(entries, list) else [entries]
+            jobs = [parse_job(entry, self.directory) for entry in entries]
+        except Exception as e:
+            entries = []
+            results.append(self._record(self._failure({'source' : None, 'output' : None}, e)))
+
+        for i, entry in enumerate(entries):
+            if self._stopping:
+                # Hand the jobs that haven't run to the next worker
+                self._write(path, entries[i:])
+                break
+            try:
+                job = self.prepare(jobs[i])
+            except Exception as e:
+                results.append(self._record(self._failure(jobs[i], e)))
+            else:
+                results.append(self._record(run_job(job)))
+
+        folder = os.path.join(self.directory, 'failed' if any(result['status'] == 'failed' for result in results)
+                              else 'done')
+        if results:
+            # Job files are often named after their feed, don't overwrite the last run of the same name
+            target, n = name, 0
+            while os.path.exists(os.path.join(folder, target)):
+                n += 1
+                target = '%s.%d' % (name, n)
+            self._write(os.path.join(folder, target + '.result'), results)
+            os.replace(running, os.path.join(folder, target))
+        else:
+            os.remove(running)
+        self._write(os.path.join(self.directory, '.status.json'), self.status())
+        return results
+
+    def poll(self, on_results=None):
+        """
+        Runs every job file waiting in the directory, oldest first
+        :param on_results: optional callable, called with the list of results of every file once it has run
+        :returns: the number of files run
+        """
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith('.json') and not name.startswith('.')]
+        ran = 0
+        for path in sorted(paths, key=lambda path: (os.path.getmtime(path) if os.path.exists(path) else 0, path)):
+            if self._stopping:
+                break
+            results = self.run_file(path)
+            if results is not None:
+                ran += 1
+                if on_results is not None:
+                    on_results(results)
+        return ran
+
+    def run(self, on_results=None):
+        """
+        Watches the directory until the worker is stopped
+        :param on_results: optional callable, called with the list of results of every file once it has run
+        :returns: the status of the worker (see status)
+        """
+        handlers = dict((signum, signal.signal(signum, self.stop)) for signum in (signal.SIGTERM, signal.SIGINT))
+        try:
+            while not self._stopping:
+                if not self.poll(on_results):
+                    time.sleep(self.interval)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        self._write(os.path.join(self.directory, '.status.json'), self.status())
+        return self.status()
+
+
+
+def format_histogram(histogram):
+    """
+    :param histogram: a histogram from Worker.histogram
+    :returns: the histogram as lines of bucket bound and jobs in that bucket alone
+    :raises: None
+    """
+    lines = []
+    previous = 0
+    for bound, count in histogram:
+        if count > previous:
+            lines.append("%-9s %8d" % ('<= %gs' % bound if bound is not None else '> %gs' % Worker.BUCKETS[-1],
+                                       count - previous))
+        previous = count
+    return "\n".join(lines)
+
+
+
+ZILLOW_OUTPUT_COLUMNS = ['MlsId', 
+                         'MlsName',
+                         'DateListed',
+                         'StreetAddress', 
+                         'Price', 
+                         'Bedrooms', 
+                         'Bathrooms',
+                         'Appliances', 
+                         'Rooms', 
+                         'Description']
+
+# The columns transform derives, each mapping to the extracted columns it is computed from and how many characters
+# of each it reads (None for the whole value). run_pipeline uses this to extract only what the output needs (see
+# project_columns)
+ZILLOW_DERIVED_COLUMNS = {'Bathrooms'   : {'Bathrooms_raw'         : None,
+                                           'FullBathrooms'         : None,
+                                           'HalfBathrooms'         : None,
+                                           'ThreeQuarterBathrooms' : None},
+                          'Description' : {'Full_Description'      : 200}}
+
+# The dtype of each output column when loading into Parquet or SQLite (see ParquetSink). The rest are strings. Price
+# is extracted as text, so the CSV keeps the feed's formatting, and only becomes a number in these typed sinks
+ZILLOW_OUTPUT_TYPES = {'MlsName'   : 'category',
+                       'State'     : 'category',
+                       'Price'     : 'float64',
+                       'Bedrooms'  : 'float64',
+                       'Bathrooms' : 'float64'}
+
+ZILLOW_PATH_TO_LISTINGS = '/Listings/Listing'
+
+ZILLOW_FEED = 'http://syndication.enterprise.websiteidx.com/feeds/BoojCodeTest.xml'
+
+# The column spec used by the extract function. This is how our extract process will know 
+#     a) the name of the columns to use in the data frame
+#     b) the XPath statement to find the data element within each 'row', 
+#     c) the type of each column, and d) whether 
+#     d) whether the XPath returns a scalar or list -- these types will need to be processed separately
+#     e) optionally, the dtype to store the column as. Low cardinality strings are dictionary encoded (category)
+ZILLOW_COLUMNS = [{'name' : 'MlsId',                 'xpath' : 'string(ListingDetails/MlsId/text())',               'vtype' : 'scalar'},
+                  {'name' : 'MlsName',               'xpath' : 'string(ListingDetails/MlsName/text())',             'vtype' : 'scalar', 'dtype' : 'category'},
+                  {'name' : 'DateListed',            'xpath' : 'string(ListingDetails/DateListed/text())',          'vtype' : 'scalar'},
+                  {'name' : 'StreetAddress',         'xpath' : 'string(Location/StreetAddress/text())',             'vtype' : 'scalar'},
+                  {'name' : 'City',                  'xpath' : 'string(Location/City/text())',                      'vtype' : 'scalar', 'dtype' : 'category'},
+                  {'name' : 'State',                 'xpath' : 'string(Location/State/text())',                     'vtype' : 'scalar', 'dtype' : 'category'},
+                  {'name' : 'Zip',                   'xpath' : 'string(Location/Zip/text())',                       'vtype' : 'scalar'},
+                  {'name' : 'Price',                 'xpath' : 'string(ListingDetails/Price/text())',               'vtype' : 'scalar'},
+                  {'name' : 'Bedrooms',              'xpath' : 'number(BasicDetails/Bedrooms/text())',              'vtype' : 'scalar'},
+                  {'name' : 'Bathrooms_raw',         'xpath' : 'number(BasicDetails/Bathrooms/text())',             'vtype' : 'scalar'},
+                  {'name' : 'FullBathrooms',         'xpath' : 'number(BasicDetails/FullBathrooms/text())',         'vtype' : 'scalar'},
+                  {'name' : 'HalfBathrooms',         'xpath' : 'number(BasicDetails/HalfBathrooms/text())',         'vtype' : 'scalar'},
+                  {'name' : 'ThreeQuarterBathrooms', 'xpath' : 'string(BasicDetails/ThreeQuarterBathrooms/text())', 'vtype' : 'scalar', 'dtype' : 'float64'},
+                  {'name' : 'Full_Description',      'xpath' : 'string(BasicDetails/Description/text())',           'vtype' : 'scalar'},
+                  {'name' : 'Appliances',            'xpath' : 'RichDetails/Appliances/*/text()',                   'vtype' : 'list'},
+                  {'name' : 'Rooms',                 'xpath' : 'RichDetails/Rooms/*/text()',                        'vtype' : 'list'}]
 
 
 
 if __name__ == "__main__":
-    xml_filename = 'http://syndication.enterprise.websiteidx.com/feeds/BoojCodeTest.xml' if len(sys.argv) <2 else sys.argv[1]
-    csv_filename = 'zillow.csv' if len(sys.argv) < 3 else sys.argv[2]
-    output_columns = [  'MlsId', 
-                        'MlsName',
-                        'DateListed',
-                        'StreetAddress', 
-                        'Price', 
-                        'Bedrooms', 
-                        'Bathrooms',
-                        'Appliances', 
-                        'Rooms', 
-                        'Description']
-    ''' 
-    The column spec used by the extract function. This is how our extract process will know 
-        a) the name of the columns to use in the data frame
-        b) the XPath statement to find the data element within each 'row', 
-        c) the type of each column, and d) whether 
-        d) whether the XPath returns a scalar or list -- these types will need to be processed separately
-    '''
-
-    columns = [{'name' : 'MlsId',                 'xpath' : 'string(ListingDetails/MlsId/text())',               'vtype' : 'scalar'},
-               {'name' : 'MlsName',               'xpath' : 'string(ListingDetails/MlsName/text())',             'vtype' : 'scalar'},
-               {'name' : 'DateListed',            'xpath' : 'string(ListingDetails/DateListed/text())',          'vtype' : 'scalar'},
-               {'name' : 'StreetAddress',         'xpath' : 'string(Location/StreetAddress/text())',             'vtype' : 'scalar'},
-               {'name' : 'City',                  'xpath' : 'string(Location/City/text())',                      'vtype' : 'scalar'},
-               {'name' : 'State',                 'xpath' : 'string(Location/State/text())',                     'vtype' : 'scalar'},
-               {'name' : 'Zip',                   'xpath' : 'string(Location/Zip/text())',                       'vtype' : 'scalar'},
-               {'name' : 'Price',                 'xpath' : 'string(ListingDetails/Price/text())',               'vtype' : 'scalar'},
-               {'name' : 'Bedrooms',              'xpath' : 'number(BasicDetails/Bedrooms/text())',              'vtype' : 'scalar'},
-               {'name' : 'Bathrooms_raw',         'xpath' : 'number(BasicDetails/Bathrooms/text())',             'vtype' : 'scalar'},
-               {'name' : 'FullBathrooms',         'xpath' : 'number(BasicDetails/FullBathrooms/text())',         'vtype' : 'scalar'},
-               {'name' : 'HalfBathrooms',         'xpath' : 'number(BasicDetails/HalfBathrooms/text())',         'vtype' : 'scalar'},
-               {'name' : 'ThreeQuarterBathrooms', 'xpath' : 'string(BasicDetails/ThreeQuarterBathrooms/text())', 'vtype' : 'scalar'},
-               {'name' : 'Full_Description',      'xpath' : 'string(BasicDetails/Description/text())',           'vtype' : 'scalar'},
-               {'name' : 'Appliances',            'xpath' : 'RichDetails/Appliances/*/text()',                   'vtype' : 'list'},
-               {'name' : 'Rooms',                 'xpath' : 'RichDetails/Rooms/*/text()',                        'vtype' : 'list'}]
-
-
-    a = extract_xml(xml_filename, columns, '/Listings/Listing')
-    b = transform(a)
-    load_csv(b, csv_filename, output_columns)
+    parser = argparse.ArgumentParser(description='Extract listings from an XML feed, transform them and load them into a CSV')
+    parser.add_argument('source', nargs='?', default=ZILLOW_FEED, help='url or filename of the XML feed')
+    parser.add_argument('output', nargs='?', default='zillow.csv',
+                        help='the CSV file to write (.gz or .zst to compress it), or a .parquet or SQLite (.db, '
+                             '.sqlite) file')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='stream the feed and process it in batches of this many listings')
+    parser.add_argument('--stream', action='store_true',
+                        help='stream the feed instead of loading the whole document at once')
+    parser.add_argument('--cache-dir', default=None,
+                        help='cache remote feeds here and skip the run when the feed hasn\'t changed')
+    parser.add_argument('--partition-by', default=None,
+                        help='comma separated columns to partition Parquet output by, i.e. State,MlsName')
+    parser.add_argument('--index', default=None,
+                        help='comma separated columns to index in SQLite output, i.e. Price,DateListed')
+    parser.add_argument('--extract-cache', default=None,
+                        help='keep extracted listings in this directory and reuse them while the feed is unchanged')
+    parser.add_argument('--metrics', default=None,
+                        help='write a JSON document of per stage and per column timings to this file (- for stdout) '
+                             'and log a summary line to stderr')
+    parser.add_argument('--metrics-columns', action='store_true',
+                        help='with --metrics, evaluate every column on its own to time it in full (slower)')
+    parser.add_argument('--state', default=None,
+                        help='run incrementally, keeping per listing state in this SQLite file (see run_incremental)')
+    parser.add_argument('--manifest', default=None,
+                        help='run every job in this JSON manifest instead of a single feed (see load_manifest)')
+    parser.add_argument('--watch', default=None,
+                        help='keep running and process the job files dropped in this directory (see Worker)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes for --manifest (defaults to the number of cores), or to '
+                             'parse a single local feed and format its CSV with')
+    args = parser.parse_args()
+
+    if args.manifest:
+        start = time.time()
+        results = run_jobs(load_manifest(args.manifest), processes=args.processes)
+        for result in results:
+            print(format_result(result))
+        failed = len([result for result in results if result['status'] == 'failed'])
+        print("%d jobs, %d failed, %.2fs" % (len(results), failed, time.time() - start))
+        sys.exit(1 if failed else 0)
+
+    if args.watch:
+        def print_results(results):
+            for result in results:
+                print(format_result(result))
+            sys.stdout.flush()
+        worker = Worker(args.watch, defaults={'cache_dir' : args.cache_dir, 'extract_cache' : args.extract_cache})
+        status = worker.run(on_results=print_results)
+        print("%(jobs)d jobs, %(failed)d failed, %(seconds).2fs processing, %(uptime).0fs up" % status)
+        print(format_histogram(status['histogram']))
+        sys.exit(0)
+
+    if args.state:
+        summary = run_incremental(args.source, ZILLOW_COLUMNS, ZILLOW_PATH_TO_LISTINGS, args.output,
+                                  ZILLOW_OUTPUT_COLUMNS, args.state, batch_size=args.batch_size or 10000)
+        print("%(new)d new, %(changed)d changed, %(unchanged)d unchanged, %(deleted)d deleted, output %(output)s"
+              % summary)
+        sys.exit(0)
 
+    metrics = Metrics(isolate_columns=args.metrics_columns) if args.metrics else None
+    rows = run_pipeline(args.source, ZILLOW_COLUMNS, ZILLOW_PATH_TO_LISTINGS, args.output, ZILLOW_OUTPUT_COLUMNS,
+                        batch_size=args.batch_size, stream=args.stream, processes=args.processes,
+                        cache_dir=args.cache_dir,
+                        partition_cols=args.partition_by.split(',') if args.partition_by else None,
+                        output_types=ZILLOW_OUTPUT_TYPES,
+                        indexes=args.index.split(',') if args.index else None, extract_cache=args.extract_cache,
+                        metrics=metrics)
+    if metrics is not None:
+        if args.metrics == '-':
+            print(metrics.to_json())
+        else:
+            with open(args.metrics, 'w') as f:
+                f.write(metrics.to_json() + "\n")
+        print(metrics.log_line(), file=sys.stderr)
+    if rows is None:
+        print("feed unchanged, " + args.output + " left as is")
@@ -0,0 +1,73 @@
+import unittest
+import copy
+import io
+import os
+import sys
+
+sys.path.append('../')
+sys.path.append('../benchmarks')
+import etl
+import generate_feed
+import run_benchmarks
+
+class TestGenerateFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = 'test_generated.xml'
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def generate(self, listings, seed):
+        f = io.StringIO()
+        generate_feed.generate_feed(f, listings, seed=seed)
+        return f.getvalue()
+
+    def test_deterministic(self):
+        self.assertEqual(self.generate(50, 1), self.generate(50, 1))
+        self.assertNotEqual(self.generate(50, 1), self.generate(50, 2))
+
+    def test_variety(self):
+        generate_feed.write_feed(self.filename, 500, seed=0)
+        df = etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS)
+        self.assertEqual(len(df), 500)
+        for col in ('Bathrooms_raw', 'FullBathrooms', 'HalfBathrooms', 'ThreeQuarterBathrooms', 'Appliances',
+                    'Rooms', 'Full_Description'):
+            self.assertTrue(0 < df[col].isnull().sum() < 500, col)
+        self.assertTrue(df['Full_Description'].str.len().max() > 1000)
+        self.assertTrue(df['Full_Description'].str.contains('<', regex=False).any())
+        self.assertTrue(df['Appliances'].str.count(',').max() > 2)
+        self.assertTrue(df.duplicated(['MlsId']).any())
+        self.assertFalse(df.duplicated(['MlsId', 'MlsName']).any())
+        self.assertEqual(len(etl.transform(df)), 500)
+
+class TestCompare(unittest.TestCase):
+
+    def setUp(self):
+        stage = {'seconds' : 1.0, 'rows' : 1000, 'rows_per_second' : 1000.0, 'peak_rss_bytes' : 100 << 20}
+        self.baseline = {'options' : {}, 'sizes' : {'1000' : dict((name, dict(stage))
+                                                                  for name in run_benchmarks.STAGES)}}
+
+    def test_within_threshold(self):
+        results = copy.deepcopy(self.baseline)
+        results['sizes']['1000']['extract']['rows_per_second'] = 800.0
+        results['sizes']['1000']['load']['peak_rss_bytes'] = 120 << 20
+        self.assertEqual(run_benchmarks.compare(results, self.baseline, threshold=0.25), [])
+
+    def test_regressions(self):
+        results = copy.deepcopy(self.baseline)
+        results['sizes']['1000']['transform']['rows_per_second'] = 700.0
+        results['sizes']['1000']['load']['peak_rss_bytes'] = 200 << 20
+        regressions = run_benchmarks.compare(results, self.baseline, threshold=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('transform', regressions[0])
+        self.assertEqual(run_benchmarks.compare(results, self.baseline, threshold=0.9), [])
+
+    def test_different_options(self):
+        results = copy.deepcopy(self.baseline)
+        results['options'] = {'batch_size' : 100}
+        self.assertEqual(len(run_benchmarks.compare(results, self.baseline)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import unittest
 import lxml 
+from lxml import etree
+import random
+import os
+import shutil
 import pandas as pd
 import sys
+import time
 
 sys.path.append("../")
 import etl
@@ -68,5 +73,219 @@ class TestExtract(unittest.TestCase):
         except TypeError:
             pass
 
+    def test_stream_matches_tree(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar'},
+                    {'name':'grandchildnode2','xpath':'string(grandchildnode2/text())','vtype':'scalar'},
+                    {'name':'grandchildnode3','xpath':'grandchildnode3/*/text()','vtype':'list'}]
+        df = etl.extract_xml(self.filename, columns, self.context)
+        df2 = etl.extract_xml(self.filename, columns, self.context, stream=True)
+        pd.testing.assert_frame_equal(df, df2)
+
+    def test_stream_relative_context(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar'}]
+        self.assertEqual(len(etl.extract_xml(self.filename, columns, 'child', stream=True)), 3)
+        self.assertEqual(len(etl.extract_xml(self.filename, columns, 'nonexistant-context', stream=True)), 0)
+
+    def test_stream_bad_context(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar'}]
+        with self.assertRaises(ValueError):
+            etl.extract_xml(self.filename, columns, '/rootnode/child[1]', stream=True)
+
+    def test_compiled_columns_match_xpath(self):
+        # Build random documents with missing, empty, repeated and mixed content elements and check the compiled
+        # extractor returns exactly what evaluating each XPath statement would
+        rand = random.Random(42)
+        texts = ['', ' ', '1', '2.5', ' -3 ', '1e3', '+4', 'abc', '.5', '<![CDATA[x, y]]>', 'a&amp;b']
+        columns  = [{'name':'a','xpath':'string(a/text())','vtype':'scalar'},
+                    {'name':'ab','xpath':'string(a/b/text())','vtype':'scalar'},
+                    {'name':'num','xpath':'number(a/b/text())','vtype':'scalar'},
+                    {'name':'star','xpath':'string(*/b/text())','vtype':'scalar'},
+                    {'name':'list','xpath':'a/c/*/text()','vtype':'list'},
+                    {'name':'count','xpath':'count(a/b)','vtype':'scalar'},
+                    {'name':'attr','xpath':'string(a/@id)','vtype':'scalar'}]
+        def element(tag, depth):
+            parts = ['<%s id="%d">' % (tag, rand.randint(0, 9)), rand.choice(texts)]
+            for i in range(rand.randint(0, 3) if depth < 3 else 0):
+                parts.append(rand.choice(['<!--c-->', element(rand.choice('abcd'), depth + 1)]))
+                parts.append(rand.choice(texts))
+            return ''.join(parts) + '</%s>' % tag
+        doc = etree.fromstring('<root>' + ''.join(element('child', 0) for i in range(300)) + '</root>')
+        listings = doc.xpath('/root/child')
+        expected = [[etl.check_value(col, child.xpath(col['xpath'], smart_strings=False)) for col in columns]
+                    for child in listings]
+        pd.testing.assert_frame_equal(pd.DataFrame(etl.get_rows(listings, columns)), pd.DataFrame(expected))
+
+    def test_compiled_columns_reuse(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar'},
+                    {'name':'grandchildnode3','xpath':'grandchildnode3/*/text()','vtype':'list'}]
+        extractor = etl.compile_columns(columns)
+        self.assertIs(etl.compile_columns(extractor), extractor)
+        df = etl.extract_xml(self.filename, extractor, self.context)
+        self.assertEqual(list(df.columns), ['grandchildnode1', 'grandchildnode3'])
+        self.assertEqual(df.iloc[0]['grandchildnode3'], "3,4")
+
+    def test_typed_columns(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar','dtype':'float64'},
+                    {'name':'grandchildnode2','xpath':'number(grandchildnode2/text())','vtype':'scalar','dtype':'Int64'},
+                    {'name':'grandchildnode3','xpath':'grandchildnode3/*/text()','vtype':'list','dtype':'category'},
+                    {'name':'grandchildnode4','xpath':'string(grandchildnode1/text())','vtype':'scalar','dtype':'string'}]
+        df = etl.extract_xml(self.filename, columns, self.context)
+        self.assertEqual(str(df['grandchildnode1'].dtype), 'float64')
+        self.assertEqual(str(df['grandchildnode2'].dtype), 'Int64')
+        self.assertEqual(str(df['grandchildnode3'].dtype), 'category')
+        self.assertEqual(str(df['grandchildnode4'].dtype), 'string')
+        self.assertEqual(df.iloc[1]['grandchildnode1'], 5.0)
+        self.assertEqual(df.iloc[2]['grandchildnode2'], 9)
+        self.assertEqual(list(df['grandchildnode3'].cat.categories), ['3,4', '7'])
+        self.assertTrue(pd.isnull(df.iloc[2]['grandchildnode3']))
+        self.assertEqual(df.iloc[0]['grandchildnode4'], '1')
+
+    def test_typed_columns_match_inferred(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar'},
+                    {'name':'grandchildnode3','xpath':'grandchildnode3/*/text()','vtype':'list'}]
+        typed = [dict(col, dtype='category') for col in columns]
+        df = etl.extract_xml(self.filename, columns, self.context)
+        df2 = etl.extract_xml(self.filename, typed, self.context, stream=True)
+        pd.testing.assert_frame_equal(df, df2.astype(object), check_dtype=False)
+
+    def test_dtype_errors(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar','dtype':'int'}]
+        with self.assertRaises(ValueError):
+            etl.extract_xml(self.filename, columns, self.context)
+        columns  = [{'name':'grandchildnode3','xpath':'grandchildnode3/*/text()','vtype':'list','dtype':'float64'}]
+        with self.assertRaises(TypeError):
+            etl.extract_xml(self.filename, columns, self.context)
+
+    def test_max_length(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar'},
+                    {'name':'grandchildnode3','xpath':'grandchildnode3/*/text()','vtype':'list','max_length':2},
+                    {'name':'description','xpath':'string(BasicDetails/Description/text())','vtype':'scalar'}]
+        df = etl.extract_xml(self.filename, columns, self.context)
+        self.assertEqual(list(df['grandchildnode3'].fillna('')), ['3,', '7', ''])
+        listings = etl.extract_xml('../test_data/test_listings.xml', columns, '/Listings/Listing')
+        columns[2]['max_length'] = 10
+        truncated = etl.extract_xml('../test_data/test_listings.xml', columns, '/Listings/Listing', stream=True)
+        self.assertEqual(list(truncated['description']), [text[:10] for text in listings['description']])
+        columns[2]['max_length'] = 0
+        with self.assertRaises(ValueError):
+            etl.extract_xml(self.filename, columns, self.context)
+
+    def test_project_columns(self):
+        projected = etl.project_columns(etl.ZILLOW_COLUMNS, etl.ZILLOW_OUTPUT_COLUMNS, etl.ZILLOW_DERIVED_COLUMNS)
+        names = [col['name'] for col in projected]
+        self.assertEqual(names, ['MlsId', 'MlsName', 'DateListed', 'StreetAddress', 'Price', 'Bedrooms',
+                                 'Bathrooms_raw', 'FullBathrooms', 'HalfBathrooms', 'ThreeQuarterBathrooms',
+                                 'Full_Description', 'Appliances', 'Rooms'])
+        self.assertEqual([col.get('max_length') for col in projected if 'max_length' in col], [200])
+        self.assertNotIn('max_length', etl.ZILLOW_COLUMNS[13])
+
+        # A column needed in full isn't truncated, and the spec's own max_length is kept when it's shorter
+        projected = etl.project_columns(etl.ZILLOW_COLUMNS, ['Description', 'Full_Description'],
+                                        etl.ZILLOW_DERIVED_COLUMNS)
+        self.assertEqual(projected, [etl.ZILLOW_COLUMNS[13]])
+        columns = [dict(etl.ZILLOW_COLUMNS[13], max_length=50)]
+        self.assertEqual(etl.project_columns(columns, ['Description'], etl.ZILLOW_DERIVED_COLUMNS)[0]['max_length'],
+                         50)
+
+    def test_parallel_matches_serial(self):
+        # Listing start tags inside CDATA sections and comments must never be used as shard boundaries
+        with open('../test_data/test_listings.xml') as f:
+            data = f.read()
+        start, end = data.index('<Listing>'), data.rindex('</Listings>')
+        tricky = data[start:end].replace('<Description><![CDATA[',
+                                         '<Description><![CDATA[<Listing> <!-- ]]><!-- <Listing> --><![CDATA[')
+        filename = 'test_parallel.xml'
+        with open(filename, 'w') as f:
+            f.write(data[:start] + tricky * 20 + data[end:])
+        try:
+            head, ranges, tail = etl.find_shards(filename, '/Listings/Listing', 4)
+            self.assertEqual(len(ranges), 4)
+            with open(filename, 'rb') as f:
+                contents = f.read()
+            for shard_start, shard_end in ranges:
+                shard = etree.fromstring(contents[:head] + contents[shard_start:shard_end] + contents[tail:])
+                self.assertTrue(len(shard.xpath('/Listings/Listing')) > 0)
+
+            df = etl.extract_xml(filename, etl.ZILLOW_COLUMNS, '/Listings/Listing')
+            df2 = etl.extract_xml_parallel(filename, etl.ZILLOW_COLUMNS, '/Listings/Listing', processes=4,
+                                           min_shard_bytes=0)
+            self.assertEqual(len(df2), 60)
+            pd.testing.assert_frame_equal(df, df2)
+        finally:
+            os.remove(filename)
+
+    def test_parallel_fallback(self):
+        columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','vtype':'scalar'},
+                    {'name':'grandchildnode3','xpath':'grandchildnode3/*/text()','vtype':'list'}]
+        self.assertIsNone(etl.find_shards(self.filename, 'child', 2))
+        df = etl.extract_xml(self.filename, columns, self.context)
+        df2 = etl.extract_xml_parallel(self.filename, columns, self.context, processes=2, min_shard_bytes=0)
+        pd.testing.assert_frame_equal(df, df2)
+
+class TestExtractCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = 'test_extract_cache'
+        self.filename = 'test_cached.xml'
+        self.context = '/Listings/Listing'
+        shutil.copy('../test_data/test_listings.xml', self.filename)
+        dtypes = {'MlsName' : 'category', 'StreetAddress' : 'string', 'Price' : 'float64', 'Bedrooms' : 'Int64'}
+        self.typed = [dict(col, dtype=dtypes[col['name']]) for col in etl.ZILLOW_COLUMNS if col['name'] in dtypes]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.remove(self.filename)
+
+    def test_cached_frame_identical(self):
+        cache = etl.ExtractCache(self.cache_dir)
+        for columns in (etl.ZILLOW_COLUMNS, self.typed):
+            df = cache.extract(self.filename, columns, self.context)
+            cached = cache.extract(self.filename, columns, self.context)
+            pd.testing.assert_frame_equal(cached, etl.extract_xml(self.filename, columns, self.context))
+            pd.testing.assert_frame_equal(cached, df)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # A new cache over the same directory finds the entries
+        cache = etl.ExtractCache(self.cache_dir)
+        cache.extract(self.filename, self.typed, self.context)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_invalidation(self):
+        cache = etl.ExtractCache(self.cache_dir)
+        cache.extract(self.filename, etl.ZILLOW_COLUMNS, self.context)
+        cache.extract(self.filename, etl.ZILLOW_COLUMNS[:5], self.context)
+        self.assertEqual(cache.misses, 2)
+
+        # Same size, different contents
+        with open(self.filename) as f:
+            data = f.read()
+        with open(self.filename, 'w') as f:
+            f.write(data.replace('CLAW', 'CLAX').replace('CLAP', 'CLAQ'))
+        df = cache.extract(self.filename, etl.ZILLOW_COLUMNS, self.context)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        self.assertEqual(set(df['MlsName']), set(['CLAX', 'CLAQ']))
+
+    def test_eviction(self):
+        cache = etl.ExtractCache(self.cache_dir)
+        cache.extract(self.filename, etl.ZILLOW_COLUMNS, self.context)
+        time.sleep(0.01)
+        cache.extract(self.filename, self.typed, self.context)
+        sizes = [size for used, size, entry in cache.entries()]
+        self.assertEqual(len(sizes), 2)
+
+        # Using the first entry makes the second the least recently used
+        time.sleep(0.01)
+        cache.extract(self.filename, etl.ZILLOW_COLUMNS, self.context)
+        cache.max_bytes = sizes[0]
+        cache.evict()
+        self.assertEqual(len(cache.entries()), 1)
+        cache.extract(self.filename, etl.ZILLOW_COLUMNS, self.context)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # An entry larger than the cache isn't kept
+        cache.max_bytes = 0
+        cache.extract(self.filename, self.typed, self.context)
+        self.assertEqual(cache.entries(), [])
+
 if __name__ == '__main__':
     unittest.main()
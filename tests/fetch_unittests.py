@@ -0,0 +1,213 @@
+import unittest
+import gzip
+import http.server
+import os
+import pandas as pd
+import shutil
+import sys
+import threading
+
+sys.path.append('../')
+import etl
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A stand-in for the syndication server. Serves test_listings.xml with an ETag, gzips it when asked to and
+    answers conditional requests with a 304.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append({'path' : self.path, 'headers' : dict(self.headers), 'peer' : self.client_address})
+        if self.path == '/moved.xml':
+            self.send_response(301)
+            self.send_header('Location', '/feed.xml')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path != '/feed.xml':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            return
+
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Type', 'application/xml')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FeedServer(http.server.ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response is part of the tests
+        pass
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = 'test_cache'
+        self.csv_filename = 'test_fetch.csv'
+        self.reference_filename = 'test_reference.csv'
+        self.filename = '../test_data/test_listings.xml'
+        self.server = FeedServer(('127.0.0.1', 0), FeedHandler)
+        self.server.requests = []
+        self.server.etag = '"v1"'
+        with open(self.filename, 'rb') as f:
+            self.server.body = f.read()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/feed.xml' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for connection in etl._connections.values():
+            connection.close()
+        etl._connections.clear()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        for filename in (self.csv_filename, self.reference_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_fetch_and_cache(self):
+        with etl.open_feed(self.url, self.cache_dir) as feed:
+            df = etl.extract_xml(feed, etl.ZILLOW_COLUMNS, '/Listings/Listing', stream=True)
+        pd.testing.assert_frame_equal(df, etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, '/Listings/Listing'))
+        self.assertEqual(self.server.requests[0]['headers']['Accept-Encoding'], 'gzip')
+        self.assertTrue(feed.bytes_read < len(self.server.body))
+
+        cached = [name for name in os.listdir(self.cache_dir) if name.endswith('.xml')]
+        self.assertEqual(len(cached), 1)
+        with open(os.path.join(self.cache_dir, cached[0]), 'rb') as f:
+            self.assertEqual(f.read(), self.server.body)
+
+        # The second request is conditional, answered with a 304 and sent over the same connection
+        self.assertIsNone(etl.open_feed(self.url, self.cache_dir))
+        self.assertEqual(self.server.requests[1]['headers']['If-None-Match'], '"v1"')
+        self.assertEqual(self.server.requests[0]['peer'], self.server.requests[1]['peer'])
+
+    def test_changed_feed(self):
+        with etl.open_feed(self.url, self.cache_dir) as feed:
+            self.assertEqual(feed.read(), self.server.body)
+        self.server.etag = '"v2"'
+        feed = etl.open_feed(self.url, self.cache_dir)
+        self.assertIsNotNone(feed)
+        feed.close()
+
+    def test_partial_read_not_cached(self):
+        feed = etl.open_feed(self.url, self.cache_dir)
+        feed.read(10)
+        feed.close()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        feed = etl.open_feed(self.url, self.cache_dir)
+        self.assertIsNotNone(feed)
+        feed.close()
+
+    def test_concurrent_fetches(self):
+        # Two jobs fetching the same url into the same cache, i.e. for two outputs, don't share a temporary file
+        first = etl.open_feed(self.url, self.cache_dir, output=self.csv_filename)
+        second = etl.open_feed(self.url, self.cache_dir, output=self.reference_filename)
+        with first, second:
+            start = first.read(100)
+            self.assertEqual(second.read(), self.server.body)
+            self.assertEqual(start + first.read(), self.server.body)
+        first.commit()
+        second.commit()
+        self.assertFalse([name for name in os.listdir(self.cache_dir) if name.endswith('.tmp')])
+        for output in (self.csv_filename, self.reference_filename):
+            with open(output, 'w'):
+                pass
+            self.assertIsNone(etl.open_feed(self.url, self.cache_dir, output=output))
+
+    def test_redirect_and_errors(self):
+        with etl.open_feed(self.url.replace('feed.xml', 'moved.xml'), self.cache_dir) as feed:
+            self.assertEqual(len(etl.extract_xml(feed, etl.ZILLOW_COLUMNS, '/Listings/Listing')), 3)
+        with self.assertRaises(IOError):
+            etl.open_feed(self.url.replace('feed.xml', 'missing.xml'), self.cache_dir)
+
+    def test_url_without_cache(self):
+        df = etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, '/Listings/Listing')
+        for stream in (False, True):
+            pd.testing.assert_frame_equal(etl.extract_xml(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing',
+                                                          stream=stream), df)
+        batches = list(etl.iter_extract_xml(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        rows = etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.csv_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS, batch_size=2)
+        self.assertEqual(rows, 3)
+        with self.assertRaises(IOError):
+            etl.extract_xml(self.url.replace('feed.xml', 'missing.xml'), etl.ZILLOW_COLUMNS, '/Listings/Listing',
+                            stream=True)
+
+    def test_pipeline_skips_unchanged_feed(self):
+        rows = etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.csv_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS, batch_size=2, cache_dir=self.cache_dir)
+        self.assertEqual(rows, 3)
+        etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.reference_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS)
+        with open(self.csv_filename) as f, open(self.reference_filename) as g:
+            self.assertEqual(f.read(), g.read())
+
+        rows = etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.csv_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS, cache_dir=self.cache_dir)
+        self.assertIsNone(rows)
+
+        # Without an output to keep, the cached copy is loaded rather than downloaded again
+        os.remove(self.csv_filename)
+        metrics = etl.Metrics()
+        rows = etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.csv_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS, cache_dir=self.cache_dir, metrics=metrics)
+        self.assertEqual(rows, 3)
+        self.assertEqual(metrics.bytes_read, len(self.server.body))
+        self.assertEqual(self.server.requests[-1]['headers']['If-None-Match'], '"v1"')
+        with open(self.csv_filename) as f, open(self.reference_filename) as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_outputs_sharing_a_feed(self):
+        for output in (self.csv_filename, self.reference_filename):
+            etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', output, etl.ZILLOW_OUTPUT_COLUMNS,
+                             cache_dir=self.cache_dir)
+        self.server.etag = '"v2"'
+        self.server.body = self.server.body.replace(b'CLAW', b'CLAX')
+        for output in (self.csv_filename, self.reference_filename):
+            rows = etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', output,
+                                    etl.ZILLOW_OUTPUT_COLUMNS, cache_dir=self.cache_dir)
+            self.assertEqual(rows, 3)
+            self.assertIn('CLAX', pd.read_csv(output)['MlsName'].tolist())
+        # The second output was loaded from the copy the first one fetched
+        self.assertEqual(len([request for request in self.server.requests if 'If-None-Match' in request['headers']]),
+                         3)
+        for output in (self.csv_filename, self.reference_filename):
+            self.assertIsNone(etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', output,
+                                               etl.ZILLOW_OUTPUT_COLUMNS, cache_dir=self.cache_dir))
+
+    def test_failed_load_not_skipped(self):
+        etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.csv_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS, cache_dir=self.cache_dir)
+        self.server.etag = '"v2"'
+        self.server.body = self.server.body.replace(b'CLAW', b'CLAX')
+        with self.assertRaises(KeyError):
+            etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.csv_filename,
+                             etl.ZILLOW_OUTPUT_COLUMNS + ['Missing'], cache_dir=self.cache_dir)
+        rows = etl.run_pipeline(self.url, etl.ZILLOW_COLUMNS, '/Listings/Listing', self.csv_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS, cache_dir=self.cache_dir)
+        self.assertEqual(rows, 3)
+        self.assertIn('CLAX', pd.read_csv(self.csv_filename)['MlsName'].tolist())
+
+if __name__ == '__main__':
+    unittest.main()
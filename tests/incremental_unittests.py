@@ -0,0 +1,102 @@
+import unittest
+import os
+import sys
+
+sys.path.append('../')
+import etl
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.csv_filename = 'test_incremental.csv'
+        self.reference_filename = 'test_reference.csv'
+        self.state_filename = 'test_state.db'
+        self.xml_filename = 'test_incremental.xml'
+        self.context = '/Listings/Listing'
+        with open('../test_data/test_listings.xml') as f:
+            self.xml = f.read()
+
+    def tearDown(self):
+        for filename in (self.csv_filename, self.reference_filename, self.state_filename, self.xml_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def run_feed(self, xml, batch_size=2):
+        with open(self.xml_filename, 'w') as f:
+            f.write(xml)
+        summary = etl.run_incremental(self.xml_filename, etl.ZILLOW_COLUMNS, self.context, self.csv_filename,
+                                      etl.ZILLOW_OUTPUT_COLUMNS, self.state_filename, batch_size=batch_size)
+        # The incremental output must always match a full run over the same feed
+        etl.run_pipeline(self.xml_filename, etl.ZILLOW_COLUMNS, self.context, self.reference_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS)
+        with open(self.csv_filename, 'rb') as f, open(self.reference_filename, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        return summary
+
+    def listings(self):
+        # Splits the test feed into its head, its listings and its tail
+        start, end = self.xml.index('<Listing>'), self.xml.rindex('</Listings>')
+        body = self.xml[start:end]
+        parts = ['<Listing>' + part for part in body.split('<Listing>')[1:]]
+        return self.xml[:start], parts, self.xml[end:]
+
+    def test_first_run(self):
+        summary = self.run_feed(self.xml)
+        self.assertEqual(summary, {'new' : 3, 'changed' : 0, 'unchanged' : 0, 'deleted' : 0, 'output' : 'rewritten'})
+
+    def test_no_changes(self):
+        self.run_feed(self.xml)
+        summary = self.run_feed(self.xml, batch_size=1)
+        self.assertEqual(summary, {'new' : 0, 'changed' : 0, 'unchanged' : 3, 'deleted' : 0, 'output' : 'unchanged'})
+
+    def test_changed_listing(self):
+        self.run_feed(self.xml)
+        summary = self.run_feed(self.xml.replace('<Price>535000.00</Price>', '<Price>499000.00</Price>'))
+        self.assertEqual(summary, {'new' : 0, 'changed' : 1, 'unchanged' : 2, 'deleted' : 0, 'output' : 'rewritten'})
+
+    def test_deleted_listing(self):
+        head, listings, tail = self.listings()
+        self.run_feed(self.xml)
+        summary = self.run_feed(head + listings[0] + listings[2] + tail)
+        self.assertEqual(summary, {'new' : 0, 'changed' : 0, 'unchanged' : 2, 'deleted' : 1, 'output' : 'rewritten'})
+
+    def test_new_listing(self):
+        head, listings, tail = self.listings()
+        self.run_feed(head + listings[0] + listings[1] + tail)
+        summary = self.run_feed(self.xml)
+        self.assertEqual(summary, {'new' : 1, 'changed' : 0, 'unchanged' : 2, 'deleted' : 0, 'output' : 'appended'})
+
+    def test_damaged_output(self):
+        head, listings, tail = self.listings()
+        self.run_feed(head + listings[0] + listings[1] + tail)
+        with open(self.csv_filename, 'a') as f:
+            f.write('left over from a failed run\n')
+        summary = self.run_feed(self.xml)
+        self.assertEqual(summary['output'], 'rewritten')
+
+    def test_duplicate_keys(self):
+        head, listings, tail = self.listings()
+        repeated = listings[0].replace('<Price>535000.00</Price>', '<Price>499000.00</Price>')
+        xml = head + listings[0] + listings[1] + repeated + listings[2] + tail
+        # The last listing with a key wins, where the feed has it
+        self.run_feed(head + listings[1] + repeated + listings[2] + tail)
+        with open(self.csv_filename, 'rb') as f:
+            expected = f.read()
+        os.remove(self.state_filename)
+
+        for batch_size in (10, 2, 1):
+            with open(self.xml_filename, 'w') as f:
+                f.write(xml)
+            summary = etl.run_incremental(self.xml_filename, etl.ZILLOW_COLUMNS, self.context, self.csv_filename,
+                                          etl.ZILLOW_OUTPUT_COLUMNS, self.state_filename, batch_size=batch_size)
+            if batch_size == 10:
+                self.assertEqual(summary, {'new' : 3, 'changed' : 0, 'unchanged' : 0, 'deleted' : 0,
+                                           'output' : 'rewritten'})
+            else:
+                self.assertEqual(summary, {'new' : 0, 'changed' : 0, 'unchanged' : 3, 'deleted' : 0,
+                                           'output' : 'unchanged'})
+            with open(self.csv_filename, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,12 @@ import unittest
 import lxml 
 import pandas as pd
 import numpy as np
+import importlib.util
 import os
+import shutil
+import sqlite3
 import sys
+import gzip
 
 sys.path.append('../')
 import etl
@@ -44,6 +48,14 @@ class TestLoad(unittest.TestCase):
         p.close()
         self.assertEqual(linecount,4)
    
+    def test_append(self):
+        df = pd.DataFrame(self.json)
+        etl.load_csv(df.iloc[:1], self.csv_filename, self.output_columns)
+        etl.load_csv(df.iloc[1:], self.csv_filename, self.output_columns, append=True)
+        with open(self.csv_filename) as f:
+            appended = f.read()
+        self.assertEqual(appended, df.to_csv(index=False, columns=self.output_columns))
+
     def test_data_equality(self):
         df = pd.DataFrame(self.json)
         etl.load_csv(df, self.csv_filename, self.output_columns)
@@ -55,5 +67,226 @@ class TestLoad(unittest.TestCase):
 
         pd.util.testing.assert_frame_equal(df, df2, check_dtype=False, check_index_type=False, check_column_type=False, check_names=False, check_less_precise=1)
 
+class TestSqlite(unittest.TestCase):
+
+    def setUp(self):
+        self.db_filename = 'test.db'
+        self.filename = '../test_data/test_listings.xml'
+        self.df = etl.transform(etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS))
+
+    def tearDown(self):
+        if os.path.exists(self.db_filename):
+            os.remove(self.db_filename)
+
+    def query(self, sql):
+        db = sqlite3.connect(self.db_filename)
+        try:
+            return db.execute(sql).fetchall()
+        finally:
+            db.close()
+
+    def test_typed_table(self):
+        etl.load_sqlite(self.df, self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES)
+        self.assertEqual([(name, sql_type) for _, name, sql_type, _, _, _ in self.query("PRAGMA table_info(listings)")],
+                         [(col, 'REAL' if col in ('Price', 'Bedrooms', 'Bathrooms') else 'TEXT')
+                          for col in etl.ZILLOW_OUTPUT_COLUMNS])
+        rows = self.query("SELECT MlsId, MlsName, Price, Bathrooms, Appliances FROM listings ORDER BY MlsId")
+        self.assertEqual(rows, [('14799273', 'CLAW', 535000.0, 3.5, None),
+                                ('14802845', 'CLAW', 200000.0, 3.0, None),
+                                ('14802846', 'CLAP', 200000.0, None, None)])
+
+    def test_upsert(self):
+        etl.load_sqlite(self.df.iloc[:2], self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES)
+        changed = self.df.copy()
+        changed['Price'] = changed['Price'].astype('float64') + 1
+        with etl.SqliteSink(self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES,
+                            chunk_size=1) as sink:
+            sink.write(changed)
+        self.assertEqual(self.query("SELECT MlsId, Price FROM listings ORDER BY MlsId"),
+                         [('14799273', 535001.0), ('14802845', 200001.0), ('14802846', 200001.0)])
+
+    def test_missing_key_upserted(self):
+        df = self.df.copy()
+        df['MlsName'] = df['MlsName'].astype(object)
+        df.loc[0, 'MlsName'] = None
+        for i in range(3):
+            etl.load_sqlite(df, self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM listings WHERE MlsName = ''"), [(1,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM listings"), [(3,)])
+        self.assertEqual(self.query("SELECT name FROM pragma_table_info('listings') WHERE \"notnull\""),
+                         [('MlsId',), ('MlsName',)])
+
+    def test_indexes(self):
+        for i in range(2):
+            etl.load_sqlite(self.df, self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES,
+                            indexes=['Price', 'DateListed'])
+        self.assertEqual(sorted(name for (name,) in self.query("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                                               "AND sql IS NOT NULL")),
+                         ['listings_DateListed', 'listings_Price'])
+        with self.assertRaises(ValueError):
+            etl.SqliteSink(self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS, indexes=['Zip'])
+
+    def test_failed_load_rolled_back(self):
+        etl.load_sqlite(self.df.iloc[:1], self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS)
+        with self.assertRaises(KeyError):
+            with etl.SqliteSink(self.db_filename, etl.ZILLOW_OUTPUT_COLUMNS) as sink:
+                sink.write(self.df.iloc[1:])
+                sink.write(self.df.drop(columns=['Price']))
+        self.assertEqual(self.query("SELECT COUNT(*) FROM listings"), [(1,)])
+
+    def test_pipeline(self):
+        rows = etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS, self.db_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS, batch_size=2, output_types=etl.ZILLOW_OUTPUT_TYPES,
+                                indexes=['Price'])
+        self.assertEqual(rows, 3)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM listings"), [(3,)])
+
+class TestCsvSink(unittest.TestCase):
+
+    def setUp(self):
+        self.outputs = ['test_sink.csv', 'test_sink.csv.gz', 'test_sink.csv.zst']
+        self.filename = '../test_data/test_listings.xml'
+        self.df = etl.transform(etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS))
+        self.expected = self.df.to_csv(index=False, columns=etl.ZILLOW_OUTPUT_COLUMNS).encode('utf-8')
+
+    def tearDown(self):
+        for filename in self.outputs:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_identical_to_csv(self):
+        for processes in (None, 2):
+            with etl.CsvSink(self.outputs[0], etl.ZILLOW_OUTPUT_COLUMNS, processes=processes, chunk_size=1) as sink:
+                sink.write(self.df.iloc[:2])
+                sink.write(self.df.iloc[:0])
+                sink.write(self.df.iloc[2:])
+            self.assertEqual(sink.rows, 3)
+            self.assertEqual(self.read(self.outputs[0]), self.expected)
+
+        with etl.CsvSink(self.outputs[0], etl.ZILLOW_OUTPUT_COLUMNS) as sink:
+            pass
+        self.assertEqual(self.read(self.outputs[0]).decode().strip(), ",".join(etl.ZILLOW_OUTPUT_COLUMNS))
+
+    def test_gzip(self):
+        for processes in (None, 2):
+            with etl.CsvSink(self.outputs[1], etl.ZILLOW_OUTPUT_COLUMNS, processes=processes, chunk_size=2) as sink:
+                sink.write(self.df)
+            self.assertEqual(gzip.decompress(self.read(self.outputs[1])), self.expected)
+
+    @unittest.skipUnless(importlib.util.find_spec('zstandard'), "zstandard isn't installed")
+    def test_zstd(self):
+        import zstandard
+        for processes in (None, 2):
+            with etl.CsvSink(self.outputs[2], etl.ZILLOW_OUTPUT_COLUMNS, processes=processes, chunk_size=2) as sink:
+                sink.write(self.df)
+            decompressor = zstandard.ZstdDecompressor().decompressobj(read_across_frames=True)
+            self.assertEqual(decompressor.decompress(self.read(self.outputs[2])), self.expected)
+
+    def test_failed_load_keeps_output(self):
+        etl.load_csv(self.df, self.outputs[0], etl.ZILLOW_OUTPUT_COLUMNS)
+        with self.assertRaises(KeyError):
+            with etl.CsvSink(self.outputs[0], etl.ZILLOW_OUTPUT_COLUMNS) as sink:
+                sink.write(self.df.drop(columns=['Price']))
+        self.assertEqual(self.read(self.outputs[0]), self.expected)
+        self.assertFalse(os.path.exists(self.outputs[0] + '.tmp'))
+        with self.assertRaises(ValueError):
+            etl.CsvSink(self.outputs[0], etl.ZILLOW_OUTPUT_COLUMNS, compression='bz2')
+
+    def test_pipeline(self):
+        for output in self.outputs[:2]:
+            rows = etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS, output,
+                                    etl.ZILLOW_OUTPUT_COLUMNS, batch_size=2, processes=2)
+            self.assertEqual(rows, 3)
+        self.assertEqual(gzip.decompress(self.read(self.outputs[1])), self.read(self.outputs[0]))
+        self.assertEqual(self.read(self.outputs[0]), self.expected)
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow isn't installed")
+class TestParquet(unittest.TestCase):
+
+    def setUp(self):
+        self.parquet_filename = 'test.parquet'
+        self.dataset_dir = 'test_dataset'
+        self.filename = '../test_data/test_listings.xml'
+        self.df = etl.transform(etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS))
+
+    def tearDown(self):
+        if os.path.exists(self.parquet_filename):
+            os.remove(self.parquet_filename)
+        shutil.rmtree(self.dataset_dir, ignore_errors=True)
+
+    def test_types(self):
+        etl.load_parquet(self.df, self.parquet_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES)
+        df = pd.read_parquet(self.parquet_filename)
+        self.assertEqual(list(df.columns), etl.ZILLOW_OUTPUT_COLUMNS)
+        self.assertEqual(str(df['MlsName'].dtype), 'category')
+        for col in ('Price', 'Bedrooms', 'Bathrooms'):
+            self.assertEqual(df[col].dtype, np.float64)
+            # Price is text in the frame (and the CSV), only the typed sinks store it as a number
+            np.testing.assert_array_equal(df[col].values, self.df[col].astype('float64').values)
+        # All null in this feed, but still strings rather than floats
+        self.assertTrue(df['Appliances'].isnull().all())
+        import pyarrow.parquet as pq
+        self.assertEqual(str(pq.read_schema(self.parquet_filename).field('Appliances').type), 'string')
+        self.assertEqual(list(df['Description']), list(self.df['Description']))
+
+    def test_batches_are_row_groups(self):
+        with etl.ParquetSink(self.parquet_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES) as sink:
+            for start in range(len(self.df)):
+                sink.write(self.df.iloc[start:start + 1])
+        import pyarrow.parquet as pq
+        self.assertEqual(pq.ParquetFile(self.parquet_filename).num_row_groups, len(self.df))
+        df = pd.read_parquet(self.parquet_filename)
+        pd.testing.assert_frame_equal(df, pd.read_parquet(self.write_once()))
+
+    def write_once(self):
+        filename = 'test_once.parquet'
+        self.addCleanup(os.remove, filename)
+        etl.load_parquet(self.df, filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES)
+        return filename
+
+    def test_partitions(self):
+        etl.load_parquet(self.df, self.dataset_dir, etl.ZILLOW_OUTPUT_COLUMNS, partition_cols=['State', 'MlsName'],
+                         types=etl.ZILLOW_OUTPUT_TYPES)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dataset_dir, 'State=CA'))),
+                         ['MlsName=CLAP', 'MlsName=CLAW'])
+        df = pd.read_parquet(os.path.join(self.dataset_dir, 'State=CA', 'MlsName=CLAW'))
+        self.assertEqual(list(df['MlsId']), ['14799273', '14802845'])
+        self.assertNotIn('MlsName', df.columns)
+
+        # Writing again replaces the whole directory
+        etl.load_parquet(self.df.iloc[2:], self.dataset_dir, etl.ZILLOW_OUTPUT_COLUMNS,
+                         partition_cols=['MlsName'], types=etl.ZILLOW_OUTPUT_TYPES)
+        self.assertEqual(os.listdir(self.dataset_dir), ['MlsName=CLAP'])
+        self.assertFalse(os.path.exists(self.dataset_dir + '.tmp'))
+
+    def test_pipeline(self):
+        rows = etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS, self.parquet_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS, batch_size=2, output_types=etl.ZILLOW_OUTPUT_TYPES)
+        self.assertEqual(rows, 3)
+        pd.testing.assert_frame_equal(pd.read_parquet(self.parquet_filename), pd.read_parquet(self.write_once()))
+
+        rows = etl.run_pipeline('../test_data/test.xml', etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS,
+                                self.parquet_filename, etl.ZILLOW_OUTPUT_COLUMNS, output_types=etl.ZILLOW_OUTPUT_TYPES)
+        self.assertEqual(rows, 0)
+        self.assertEqual(list(pd.read_parquet(self.parquet_filename).columns), etl.ZILLOW_OUTPUT_COLUMNS)
+
+    def test_failed_load_keeps_output(self):
+        etl.load_parquet(self.df, self.parquet_filename, etl.ZILLOW_OUTPUT_COLUMNS, types=etl.ZILLOW_OUTPUT_TYPES)
+        with self.assertRaises(KeyError):
+            with etl.ParquetSink(self.parquet_filename, etl.ZILLOW_OUTPUT_COLUMNS,
+                                 types=etl.ZILLOW_OUTPUT_TYPES) as sink:
+                sink.write(self.df.iloc[:2])
+                sink.write(self.df.drop(columns=['Price']))
+        self.assertEqual(len(pd.read_parquet(self.parquet_filename)), 3)
+        self.assertFalse(os.path.exists(self.parquet_filename + '.tmp'))
+
+    def test_bad_type(self):
+        with self.assertRaises(ValueError):
+            etl.ParquetSink(self.parquet_filename, etl.ZILLOW_OUTPUT_COLUMNS, types={'Price' : 'float32'})
+
 if __name__ == '__main__':
     unittest.main()
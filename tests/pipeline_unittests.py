@@ -0,0 +1,153 @@
+import unittest
+import copy
+import json
+import pandas as pd
+import os
+import shutil
+import sys
+
+sys.path.append('../')
+import etl
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.csv_filename = 'test.csv'
+        self.batch_filename = 'test_batch.csv'
+        self.filename = '../test_data/test_listings.xml'
+        self.context = '/Listings/Listing'
+
+    def tearDown(self):
+        for filename in (self.csv_filename, self.batch_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_batch_sizes(self):
+        batches = list(etl.iter_extract_xml(self.filename, etl.ZILLOW_COLUMNS, self.context, 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertEqual(list(batches[0].columns), [col['name'] for col in etl.ZILLOW_COLUMNS])
+
+    def test_batches_match_extract(self):
+        df = etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, self.context)
+        batches = list(etl.iter_extract_xml(self.filename, etl.ZILLOW_COLUMNS, self.context, 3))
+        self.assertEqual(len(batches), 1)
+        pd.testing.assert_frame_equal(df, batches[0])
+
+    def test_batched_output_identical(self):
+        rows = etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.csv_filename,
+                                etl.ZILLOW_OUTPUT_COLUMNS)
+        self.assertEqual(rows, 3)
+        for batch_size in (1, 2, 3, 10):
+            rows = etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.batch_filename,
+                                    etl.ZILLOW_OUTPUT_COLUMNS, batch_size=batch_size)
+            self.assertEqual(rows, 3)
+            self.assertEqual(self.read(self.csv_filename), self.read(self.batch_filename))
+
+    def test_truncated_feed_keeps_output(self):
+        etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.batch_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS)
+        before = self.read(self.batch_filename)
+        # Cut the feed off inside its last listing, after the first batches have been written
+        data = self.read(self.filename)
+        truncated = 'test_truncated.xml'
+        with open(truncated, 'wb') as f:
+            f.write(data[:data.rindex(b'<Listing>') + 50])
+        try:
+            with self.assertRaises(etl.etree.XMLSyntaxError):
+                etl.run_pipeline(truncated, etl.ZILLOW_COLUMNS, self.context, self.batch_filename,
+                                 etl.ZILLOW_OUTPUT_COLUMNS, batch_size=1)
+        finally:
+            os.remove(truncated)
+        self.assertEqual(self.read(self.batch_filename), before)
+        self.assertFalse(os.path.exists(self.batch_filename + '.tmp'))
+
+    def test_price_format_kept(self):
+        # Prices are written as they appear in the feed, not reformatted as floats
+        etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.csv_filename, etl.ZILLOW_OUTPUT_COLUMNS)
+        self.assertIn(b',535000.00,', self.read(self.csv_filename))
+
+    def test_empty_feed(self):
+        etl.run_pipeline('../test_data/test.xml', etl.ZILLOW_COLUMNS, self.context, self.csv_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS)
+        etl.run_pipeline('../test_data/test.xml', etl.ZILLOW_COLUMNS, self.context, self.batch_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS, batch_size=2)
+        self.assertEqual(self.read(self.csv_filename), self.read(self.batch_filename))
+        self.assertEqual(self.read(self.batch_filename).decode().strip(), ",".join(etl.ZILLOW_OUTPUT_COLUMNS))
+
+    def test_bad_batch_size(self):
+        with self.assertRaises(ValueError):
+            list(etl.iter_extract_xml(self.filename, etl.ZILLOW_COLUMNS, self.context, 0))
+
+    def test_projection_output_identical(self):
+        # Everything in the spec extracted, and the description kept in full
+        df = etl.transform(etl.extract_xml(self.filename, etl.ZILLOW_COLUMNS, self.context))
+        etl.load_csv(df, self.csv_filename, etl.ZILLOW_OUTPUT_COLUMNS)
+        for batch_size in (None, 2):
+            etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.batch_filename,
+                             etl.ZILLOW_OUTPUT_COLUMNS, batch_size=batch_size)
+            self.assertEqual(self.read(self.csv_filename), self.read(self.batch_filename))
+
+    def test_extract_cache_output_identical(self):
+        cache = etl.ExtractCache('test_extract_cache')
+        try:
+            etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.csv_filename,
+                             etl.ZILLOW_OUTPUT_COLUMNS)
+            for i in range(2):
+                etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.batch_filename,
+                                 etl.ZILLOW_OUTPUT_COLUMNS, extract_cache=cache)
+                self.assertEqual(self.read(self.csv_filename), self.read(self.batch_filename))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+        finally:
+            shutil.rmtree('test_extract_cache', ignore_errors=True)
+
+    def test_metrics(self):
+        events = []
+        metrics = etl.Metrics(hooks=[lambda event, stage, m: events.append((event, stage))])
+        columns = copy.deepcopy(etl.ZILLOW_COLUMNS)
+        columns[3]['xpath'] = 'normalize-space(Location/StreetAddress)'
+        rows = etl.run_pipeline(self.filename, columns, self.context, self.batch_filename, etl.ZILLOW_OUTPUT_COLUMNS,
+                                batch_size=2, metrics=metrics)
+        report = json.loads(metrics.to_json())
+        self.assertEqual(rows, 3)
+        for stage in ('extract', 'transform', 'load'):
+            self.assertEqual(report['stages'][stage]['rows'], 3)
+            self.assertTrue(report['stages'][stage]['seconds'] > 0)
+        projected = etl.project_columns(columns, etl.ZILLOW_OUTPUT_COLUMNS, etl.ZILLOW_DERIVED_COLUMNS)
+        self.assertEqual(list(report['columns']), [col['name'] for col in projected])
+        self.assertEqual(len(report['column_walk']['columns']), len(projected) - 1)
+        self.assertEqual(report['bytes_read'], os.path.getsize(self.filename))
+        self.assertTrue(report['peak_rss_bytes'] > 0)
+        self.assertIn('transform', metrics.log_line())
+
+        # Every stage is bracketed by start and end, and the run finishes once
+        self.assertEqual(events.count(('start', 'transform')), 2)
+        # One load per batch, plus closing the sink that commits the output
+        self.assertEqual(events.count(('start', 'load')), 3)
+        self.assertEqual(events.count(('start', 'extract')), events.count(('end', 'extract')))
+        self.assertEqual(events[-1], ('finish', None))
+
+        # Measuring doesn't change what is written
+        etl.run_pipeline(self.filename, columns, self.context, self.csv_filename, etl.ZILLOW_OUTPUT_COLUMNS,
+                         batch_size=2)
+        self.assertEqual(self.read(self.csv_filename), self.read(self.batch_filename))
+
+    def test_metrics_isolated_columns(self):
+        metrics = etl.Metrics(isolate_columns=True)
+        etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.batch_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS, metrics=metrics)
+        report = metrics.report()
+        projected = etl.project_columns(etl.ZILLOW_COLUMNS, etl.ZILLOW_OUTPUT_COLUMNS, etl.ZILLOW_DERIVED_COLUMNS)
+        self.assertEqual(list(report['columns']), [col['name'] for col in projected])
+        self.assertEqual(report['column_walk']['columns'], [])
+        self.assertTrue(all(seconds > 0 for seconds in report['columns'].values()))
+
+        etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, self.context, self.csv_filename,
+                         etl.ZILLOW_OUTPUT_COLUMNS)
+        self.assertEqual(self.read(self.csv_filename), self.read(self.batch_filename))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+
+sys.path.append('../')
+import etl
+
+class TestRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest_filename = 'test_manifest.json'
+        self.spec_filename = 'test_spec.json'
+        self.outputs = ['test_job1.csv', 'test_job2.csv', 'test_job3.csv', 'test_reference.csv']
+        self.filename = '../test_data/test_listings.xml'
+        with open(self.spec_filename, 'w') as f:
+            json.dump(etl.ZILLOW_COLUMNS, f)
+        manifest = [{'source' : self.filename, 'output' : self.outputs[0]},
+                    {'source' : '../test_data/empty.xml', 'output' : self.outputs[1]},
+                    {'source' : '../test_data/test.xml', 'output' : self.outputs[2], 'columns' : self.spec_filename,
+                     'path_to_listings' : '/rootnode/child', 'output_columns' : ['MlsId', 'Bathrooms'],
+                     'batch_size' : 2}]
+        with open(self.manifest_filename, 'w') as f:
+            json.dump(manifest, f)
+
+    def tearDown(self):
+        for filename in self.outputs + [self.manifest_filename, self.spec_filename]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_load_manifest(self):
+        jobs = etl.load_manifest(self.manifest_filename)
+        self.assertEqual(len(jobs), 3)
+        self.assertEqual(jobs[0]['columns'], etl.ZILLOW_COLUMNS)
+        self.assertEqual(jobs[0]['output_columns'], etl.ZILLOW_OUTPUT_COLUMNS)
+        self.assertEqual(jobs[2]['columns'], etl.ZILLOW_COLUMNS)
+        self.assertEqual(jobs[2]['batch_size'], 2)
+
+    def test_bad_manifest(self):
+        with open(self.manifest_filename, 'w') as f:
+            json.dump([{'source' : self.filename}], f)
+        with self.assertRaises(ValueError):
+            etl.load_manifest(self.manifest_filename)
+
+    def test_run_jobs(self):
+        results = etl.run_jobs(etl.load_manifest(self.manifest_filename), processes=2)
+        self.assertEqual([result['status'] for result in results], ['ok', 'failed', 'ok'])
+        self.assertEqual([result['rows'] for result in results], [3, 0, 3])
+        self.assertTrue(results[1]['error'].startswith('XMLSyntaxError'))
+        self.assertTrue(all(result['seconds'] >= 0 for result in results))
+
+        # A job run in the pool writes the same file as a job run directly
+        etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS, self.outputs[3],
+                         etl.ZILLOW_OUTPUT_COLUMNS)
+        with open(self.outputs[0]) as f, open(self.outputs[3]) as g:
+            self.assertEqual(f.read(), g.read())
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', 'workers must inherit the patched pipeline')
+    def test_dead_worker(self):
+        outputs = ['test_dead%d.csv' % i for i in range(8)]
+        self.outputs.extend(outputs)
+        run_pipeline = etl.run_pipeline
+        def exit_on_source(source, *args, **kwargs):
+            if source == 'exit':
+                os._exit(1)
+            return run_pipeline(source, *args, **kwargs)
+        etl.run_pipeline = exit_on_source
+        try:
+            jobs = [etl.parse_job({'source' : 'exit' if i == 2 else self.filename, 'output' : output})
+                    for i, output in enumerate(outputs)]
+            results = etl.run_jobs(jobs, processes=2)
+        finally:
+            etl.run_pipeline = run_pipeline
+        self.assertEqual([result['status'] for result in results], ['ok'] * 2 + ['failed'] + ['ok'] * 5)
+        self.assertTrue(results[2]['error'].startswith('BrokenProcessPool'))
+        self.assertEqual([result['rows'] for result in results], [3] * 2 + [0] + [3] * 5)
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = 'test_watch'
+        self.outputs = ['test_watch1.csv', 'test_watch2.csv', 'test_watch3.csv', 'test_reference.csv']
+        self.filename = '../test_data/test_listings.xml'
+        os.makedirs(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        for filename in self.outputs:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def submit(self, name, jobs):
+        with open(os.path.join(self.directory, '.' + name), 'w') as f:
+            json.dump(jobs, f)
+        os.rename(os.path.join(self.directory, '.' + name), os.path.join(self.directory, name))
+
+    def read(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def test_poll(self):
+        worker = etl.Worker(self.directory)
+        self.submit('job1.json', {'source' : self.filename, 'output' : self.outputs[0]})
+        self.submit('job2.json', [{'source' : self.filename, 'output' : self.outputs[1]},
+                                  {'source' : '../test_data/empty.xml', 'output' : self.outputs[2]}])
+        with open(os.path.join(self.directory, 'job3.json'), 'w') as f:
+            f.write('{"source"')
+        reported = []
+        self.assertEqual(worker.poll(reported.append), 3)
+        self.assertEqual(worker.poll(reported.append), 0)
+        self.assertEqual(sorted(len(results) for results in reported), [1, 1, 2])
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'done'))), ['job1.json', 'job1.json.result'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'failed'))),
+                         ['job2.json', 'job2.json.result', 'job3.json', 'job3.json.result'])
+        results = json.loads(self.read(os.path.join(self.directory, 'failed', 'job2.json.result')))
+        self.assertEqual([result['status'] for result in results], ['ok', 'failed'])
+
+        etl.run_pipeline(self.filename, etl.ZILLOW_COLUMNS, etl.ZILLOW_PATH_TO_LISTINGS, self.outputs[3],
+                         etl.ZILLOW_OUTPUT_COLUMNS)
+        self.assertEqual(self.read(self.outputs[0]), self.read(self.outputs[3]))
+        self.assertEqual(self.read(self.outputs[1]), self.read(self.outputs[3]))
+
+        status = json.loads(self.read(os.path.join(self.directory, '.status.json')))
+        self.assertEqual((status['jobs'], status['failed']), (4, 2))
+        self.assertEqual(status['histogram'][-1], [None, 4])
+        self.assertEqual(sum(worker.counts), 4)
+
+        # The same name again doesn't overwrite the earlier run
+        self.submit('job1.json', {'source' : self.filename, 'output' : self.outputs[0]})
+        worker.poll()
+        self.assertIn('job1.json.1.result', os.listdir(os.path.join(self.directory, 'done')))
+
+    def test_compiled_specs_reused(self):
+        worker = etl.Worker(self.directory, defaults={'batch_size' : 2})
+        job = etl.parse_job({'source' : self.filename, 'output' : self.outputs[0]})
+        prepared = worker.prepare(job)
+        self.assertIsInstance(prepared['columns'], etl.ColumnExtractor)
+        self.assertIs(worker.prepare(job)['columns'], prepared['columns'])
+        self.assertIs(etl.project_columns(prepared['columns'], etl.ZILLOW_OUTPUT_COLUMNS, etl.ZILLOW_DERIVED_COLUMNS),
+                      prepared['columns'])
+        self.assertEqual(prepared['batch_size'], 2)
+        self.assertEqual(etl.run_job(prepared)['rows'], 3)
+
+    def test_stop_hands_back_jobs(self):
+        worker = etl.Worker(self.directory)
+        record = worker._record
+        def record_and_stop(result):
+            worker.stop()
+            return record(result)
+        worker._record = record_and_stop
+        jobs = [{'source' : self.filename, 'output' : output} for output in self.outputs[:3]]
+        self.submit('jobs.json', jobs)
+        self.assertEqual(worker.poll(), 1)
+        self.assertEqual(worker.jobs, 1)
+        self.assertTrue(os.path.exists(self.outputs[0]))
+        self.assertFalse(os.path.exists(self.outputs[1]))
+        self.assertEqual(json.loads(self.read(os.path.join(self.directory, 'jobs.json'))), jobs[1:])
+
+    def test_signal_stops_run(self):
+        worker = etl.Worker(self.directory, interval=0.05)
+        self.submit('job1.json', {'source' : self.filename, 'output' : self.outputs[0]})
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        reported = []
+        status = worker.run(reported.append)
+        timer.join()
+        self.assertEqual(status['jobs'], 1)
+        self.assertEqual([[result['status'] for result in results] for results in reported], [['ok']])
+        self.assertIs(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+if __name__ == '__main__':
+    unittest.main()
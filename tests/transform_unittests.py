@@ -1,6 +1,7 @@
 import unittest
 import lxml 
 import pandas as pd
+import numpy as np
 import sys
 
 sys.path.append('../')
@@ -50,6 +51,50 @@ class TestTransform(unittest.TestCase):
         df = pd.DataFrame(self.json)
         df = etl.transform(df)
         self.assertEqual(len(df.iloc[0]['Description']),200)
+
+    def test_engines_match_fixture(self):
+        df = etl.transform(pd.DataFrame(self.json), engine='vectorized')
+        df2 = etl.transform(pd.DataFrame(self.json), engine='rowwise')
+        pd.testing.assert_frame_equal(df, df2)
+
+    def test_engines_match_random(self):
+        # Property style check: random mixes of NaN, zero and fractional bath counts must transform identically
+        # with both engines, dtypes included
+        rand = np.random.RandomState(7)
+        counts = [np.nan, 0.0, 1.0, 2.0, 3.0]
+        raws = [np.nan, 0.0, 1.0, 1.5, 2.75, 4.0]
+        for i in range(300):
+            n = rand.randint(1, 40)
+            def column(values):
+                # Bias some columns towards all missing / all present values, where dtype inference differs
+                col = rand.choice(values, n)
+                col[rand.rand(n) < rand.choice([0.0, 0.5, 1.0])] = np.nan
+                return col
+            lengths = rand.randint(0, 400, n)
+            df = pd.DataFrame({'StreetAddress':         [None if rand.rand() < 0.2 else 'addr %d' % j for j in range(n)],
+                               'Bathrooms_raw':         column(raws),
+                               'FullBathrooms':         column(counts),
+                               'HalfBathrooms':         column(counts),
+                               'ThreeQuarterBathrooms': column(counts),
+                               'Full_Description':      [None if l < 40 else 'x' * l for l in lengths],
+                               'Appliances':            [None] * n,
+                               'Rooms':                 [None] * n})
+            vectorized = etl.transform(df.copy(), engine='vectorized')
+            rowwise = etl.transform(df.copy(), engine='rowwise')
+            pd.testing.assert_frame_equal(vectorized, rowwise)
+
+    def test_missing_columns(self):
+        for engine in ('vectorized', 'rowwise'):
+            df = etl.transform(pd.DataFrame(self.json).drop(columns=['FullBathrooms', 'Full_Description']),
+                               engine=engine)
+            self.assertNotIn('Bathrooms', df.columns)
+            self.assertNotIn('Description', df.columns)
+            df = etl.transform(pd.DataFrame(self.json)[['MlsId', 'Full_Description']], engine=engine)
+            self.assertEqual(list(df.columns), ['MlsId', 'Full_Description', 'Description'])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            etl.transform(pd.DataFrame(self.json), engine='parallel')
 ''' 
     def test_empty_files(self):
         columns  = [{'name':'grandchildnode1','xpath':'string(grandchildnode1/text())','ctype':'scalar'},